@@ -1,3 +1,4 @@
+import os
 import glob
 import xml.etree.ElementTree as ET
 import subprocess
@@ -9,6 +10,7 @@ import time
 import logging
 import re
 import pika_process
+import db_broker
 import json
 import trapum_db_fold
 from datetime import datetime
@@ -33,11 +35,22 @@ def a_to_pdot(P_s, acc_ms2):
 def middle_epoch(epoch_start, no_of_samples, tsamp):
      return epoch_start +0.5*no_of_samples*tsamp 
 
+def connect_trapum():
+    # TRAPUM_DB_DSN, e.g. sqlite:///trapum.db, selects a database other than the server below
+    if os.environ.get("TRAPUM_DB_DSN"):
+        return trapum_db_fold.open_database(os.environ["TRAPUM_DB_DSN"])
+    return trapum_db_fold.TrapumDataBase("host ip","port","db_name","user","passwd")
+
+# Writes database updates the folding does not wait on in the background, set up in main
+db_writer = None
+
 def extract_and_fold(opts,info):
 
     xml={}
 
     xml_file = info["xml_path"]+'/overview.xml'
+    if not os.path.isfile(xml_file):
+        raise pika_process.PermanentFailure("Search output %s does not exist"%xml_file)
     tree = ET.parse(xml_file)
     root = tree.getroot()
 
@@ -95,6 +108,8 @@ def extract_and_fold(opts,info):
     source_name = xml['source_name']    
     #mask_path = xml['killfile_name'].split(".")[0]+".mask"
     mask_path = "/beegfs/u/prajwalvp/trapum_processing/mask_for_beam2_Ter5_16apr20/Ter5_full_res_stats_time_2_rfifind.mask" #Hardcoded
+    if not os.path.isfile(mask_path):
+        raise pika_process.PermanentFailure("Mask file %s does not exist"%mask_path)
 
     batch_no = info["batch_number"]
 
@@ -107,79 +122,64 @@ def extract_and_fold(opts,info):
         pass
 
    
-    # Setup database connection
-    log.debug("Connecting to TrapumDB...")
+    # Setup database connection (pooled, connects on first use)
+    trapum = connect_trapum()
     try:
-        trapum = trapum_db_fold.TrapumDataBase("host ip","port","db_name","user","passwd");
-        t =trapum.connect()
-    except:
-        log.error("DB connection failed")
-        pass
-    log.debug("Connected to TrapumDB")
-
-    # Get group of filenames
-    input_name = info['subgroup_files']
-
-    # Get processing id
-    processing_id = info['processing_id']
-
-    # Create_processing_pivot_entries
-    dp_ids = info["dp_ids"]
-    pp_ids=[]
-    for dp_id in dp_ids:
-        pp_id = trapum.create_pivot(dp_id,processing_id)
-        pp_ids.append(pp_id)
-
-    # Start time update
-    start_time = str(datetime.now())
-    trapum.update_start_time(start_time,processing_id)
-
-    # No of cands manual for testing
-    #no_of_cands=1
-
-    # Run in batches
-    extra = no_of_cands%batch_no
-    batches = int(no_of_cands/batch_no) +1
-    for x in range(batches):
-       start = x*batch_no
-       if(x==batches-1):
-           end = x*batch_no+extra
-       else:
-           end = (x+1)*batch_no   
-       for i in range(start,end):
-           folding_packet={}
-           folding_packet['period'] = mod_period[i]
-           folding_packet['acc'] = acc[i]
-           folding_packet['pdot'] = pdot[i] 
-           folding_packet['dm'] = dm[i] 
-           output_name= "dm_%.2f_acc_%.2f_candidate_number_%d"%(folding_packet['dm'],folding_packet['acc'],i)
-           try:
-               process = subprocess.Popen("prepfold -ncpus 1 -mask %s -noxwin -nodmsearch -topo -p %s -pd %s -dm %s %s -o %s"%(mask_path,str(folding_packet['period']),str(folding_packet['pdot']),str(folding_packet['dm']),input_name,output_name),shell=True,cwd=output_path)
-           except Exception as error:
-               trapum.update_processing_status("Failed",processing_id)
-               trapum.update_processing_notes(str(error).replace("'",""),processing_id)
-               log.error(error)
+        # Get group of filenames
+        input_name = info['subgroup_files']
+
+        # Get processing id
+        processing_id = info['processing_id']
+
+        # Create_processing_pivot_entries
+        dp_ids = info["dp_ids"]
+        db_writer.submit("create_pivots",dp_ids,processing_id)
+
+        # Get pointing and beam id from one of the dp_ids. Looked up before folding
+        # so that a database outage fails the message, to be retried, rather than
+        # the folds going unrecorded
+        pb_list = trapum.get_pb_from_dp(dp_ids[-1])
+
+        # Start, end time and status update
+        with trapum.processing_lifecycle(processing_id,writer=db_writer) as lifecycle:
+
+            # No of cands manual for testing
+            #no_of_cands=1
+
+            # Run in batches
+            extra = no_of_cands%batch_no
+            batches = int(no_of_cands/batch_no) +1
+            for x in range(batches):
+               start = x*batch_no
+               if(x==batches-1):
+                   end = x*batch_no+extra
+               else:
+                   end = (x+1)*batch_no   
+               for i in range(start,end):
+                   folding_packet={}
+                   folding_packet['period'] = mod_period[i]
+                   folding_packet['acc'] = acc[i]
+                   folding_packet['pdot'] = pdot[i] 
+                   folding_packet['dm'] = dm[i] 
+                   output_name= "dm_%.2f_acc_%.2f_candidate_number_%d"%(folding_packet['dm'],folding_packet['acc'],i)
+                   try:
+                       process = subprocess.Popen("prepfold -ncpus 1 -mask %s -noxwin -nodmsearch -topo -p %s -pd %s -dm %s %s -o %s"%(mask_path,str(folding_packet['period']),str(folding_packet['pdot']),str(folding_packet['dm']),input_name,output_name),shell=True,cwd=output_path)
+                   except Exception as error:
+                       lifecycle.fail(error)
+                       log.error(error)
  
-       if  process.communicate()[0]==None:
-           continue
-       else:
-           time.sleep(10)
-
+               if  process.communicate()[0]==None:
+                   continue
+               else:
+                   time.sleep(10)
 
-    # End time update
-    end_time = str(datetime.now())
-    trapum.update_end_time(end_time,processing_id)
-    trapum.update_processing_status("Successful",processing_id)
 
-
-    # Get pointing and beam id from one of the dp_ids
-    try:
-        pb_list = trapum.get_pb_from_dp(dp_id)
-    except Exception as error:
-        log.error(error)
-
-    # Update Dataproducts with peasoup output entry
-    dp_id = trapum.create_secondary_dataproduct(pb_list[0],pb_list[1],processing_id,1,"unscored_cands",str(output_path),10)
+        # Update Dataproducts with peasoup output entry. Written directly rather
+        # than through db_writer as in search, since dp_id goes into the score packet
+        dp_id = trapum.create_secondary_dataproduct(pb_list[0],pb_list[1],processing_id,1,"unscored_cands",str(output_path),10)
+    finally:
+        # Give the connection back to the pool now rather than when this frame is collected
+        trapum.close()
 
     # Create scoring processing
     
@@ -197,13 +197,12 @@ def extract_and_fold(opts,info):
     # Publish to Rabbit
     log.debug("Ready to publish to RabbitMQ")
     opts.queue = "pics_original_Ter5_all_beams"
-    pika_process.publish_info(opts,pics_info)
+    pika_process.publish_info(opts,pics_info,"score")
 
 
 
 def receive_message(message,opts):
-    global info
-    info = json.loads(message.decode("utf=8"))
+    info = pika_process.decode_message(message, "fold")
     extract_and_fold(opts,info)
 
                 
@@ -212,14 +211,24 @@ if __name__=='__main__':
     # Update all input arguments
     consume_parser = optparse.OptionParser()
     pika_process.add_pika_process_opts(consume_parser)
+    consume_parser.add_option('--db_journal',type=str,help='file to spool database updates to while the database is unreachable',dest="db_journal",default="trapum_db_journal_fold.jsonl")
     opts,args = consume_parser.parse_args()
 
 
     # Setup logging config
     log_type=opts.log_level
     log.setLevel(log_type.upper())
+    logging.getLogger('trapum_db').setLevel(log_type.upper())
+
+    # Database updates are applied in the background, replaying any spooled ones first
+    db_writer = trapum_db_fold.WriteBehindJournal(connect_trapum,opts.db_journal)
 
     #Consume message from RabbitMQ 
+    # --transport db keeps the queues in the database instead of RabbitMQ
+    pika_process.register_transport("db",lambda url,parameters: db_broker.connect(connect_trapum))
+
     processor = pika_process.pika_process_from_opts(opts)
-    processor.process(lambda message: receive_message(message,opts))
+    # Serve the database statement timings with the other metrics and log the database share of each message
+    processor.add_metrics_collector(trapum_db_fold.query_stats.render)
+    processor.process(trapum_db_fold.query_stats.timed(lambda message: receive_message(message,opts),"fold"))
 
@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import socket
+import itertools
+import threading
+import logging
+import memory_broker
+import pika_process
+
+
+log = logging.getLogger('db_broker')
+
+# Seconds a claimed message stays claimed without its worker renewing the lease
+LEASE_SECONDS = 300.0
+# Seconds between queries for work when polled without waiting, e.g. by start_consuming
+POLL_INTERVAL = 1.0
+
+# Arguments of the queues declared in this process, see DatabaseBroker.declare
+_queue_arguments = {}
+
+
+def _is_connection_error(error):
+    # DB-API modules, MySQLdb and sqlite3 alike, raise these when the database is unavailable
+    return any(cls.__name__ in ("OperationalError", "InterfaceError") for cls in type(error).__mro__)
+
+def _processing_id(body):
+    # Whichever codec the packet was published with
+    try:
+        return int(pika_process.decode_message(body)["processing_id"])
+    except Exception:
+        return None
+
+
+class DatabaseBroker(object):
+    """
+    Message broker keeping its queues in the Work_Queue table of the Trapum
+    database, with the interface of memory_broker.MemoryBroker so that it is
+    used through a MemoryConnection.
+
+    A worker claims the next ready message of a queue by taking a lease on
+    its row, with SELECT ... FOR UPDATE SKIP LOCKED on MySQL and inside an
+    immediate transaction on SQLite. The lease is renewed from a background
+    thread while the message is handled. The row is deleted when the message
+    is acknowledged and made ready again when it is rejected or its channel
+    closes. A lease that runs out, because its worker crashed, makes the
+    message claimable again, and it is then delivered as redelivered. While
+    a message with a processing_id is claimed, that processing's status is
+    'claimed' instead of 'enqueued'.
+
+    Queues with x-message-ttl and x-dead-letter-routing-key, such as the
+    retry delay queues, are not stored: their messages go straight to the
+    dead-letter queue and become ready there once the TTL has passed.
+    """
+    def __init__(self, db_factory, lease=LEASE_SECONDS):
+        self._db_factory = db_factory
+        # The broker and lease renewer hold their connections for good, so
+        # they are kept out of the pool that the handlers take theirs from
+        self._db = db_factory()
+        self._db.pooled = False
+        self._lease = lease
+        self._owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), id(self))
+        self._lock = threading.RLock()
+        self._claimed = {}
+        self._last_empty = {}
+        self._channel_ids = itertools.count(1)
+        self._channels = set()
+        self._closed = threading.Event()
+        self._renewer = threading.Thread(target=self._renew_leases)
+        self._renewer.daemon = True
+        self._renewer.start()
+
+    def _call(self, method, *args):
+        with self._lock:
+            try:
+                return method(*args)
+            except Exception as error:
+                if not _is_connection_error(error):
+                    raise
+                self._db.close(discard=True)
+                raise memory_broker.ConnectionLost(str(error))
+
+    def _renew_leases(self):
+        db = None
+        while not self._closed.wait(self._lease/3.0):
+            if not self._claimed:
+                continue
+            try:
+                if db is None:
+                    db = self._db_factory()
+                    db.pooled = False
+                db.execute_update("update Work_Queue set lease_expires=%s where lease_owner=%s and state='claimed'",
+                                  (time.time()+self._lease, self._owner))
+            except Exception:
+                log.exception("Failed to renew the leases of {}".format(self._owner))
+                if db is not None:
+                    db.close(discard=True)
+                    db = None
+        if db is not None:
+            db.close()
+
+    def _set_processing_status(self, processing_id, old, new):
+        # Left uncommitted, to go in the same transaction as the change to the message
+        if processing_id is not None:
+            self._db.execute_query("update Processings set process_status=%s where processing_id=%s and process_status=%s",
+                                   (new, processing_id, old))
+
+    def open_channel(self):
+        channel_id = next(self._channel_ids)
+        self._channels.add(channel_id)
+        return channel_id
+
+    def declare(self, name, arguments=None):
+        _queue_arguments[name] = dict(arguments or {})
+        return self.message_count(name)
+
+    def publish(self, name, body, properties=None):
+        if isinstance(body, type(u"")):
+            body = body.encode("utf-8")
+        properties = dict(properties or {})
+        available_at = time.time()
+        arguments = _queue_arguments.get(name, {})
+        if arguments.get("x-message-ttl") is not None and arguments.get("x-dead-letter-routing-key"):
+            headers = dict(properties.get("headers") or {})
+            headers.setdefault("x-death", []).append({"queue": name, "reason": "expired"})
+            properties["headers"] = headers
+            available_at += arguments["x-message-ttl"]/1000.0
+            name = arguments["x-dead-letter-routing-key"]
+        self._call(self._db.execute_update,
+                   "insert into Work_Queue(queue,processing_id,priority,body,properties,state,available_at,enqueued_at) "
+                   "values (%s,%s,%s,%s,%s,'ready',%s,%s)",
+                   (name, _processing_id(body), properties.get("priority") or 0, body,
+                    json.dumps(properties), available_at, time.time()))
+
+    def _claim(self, name, channel_id):
+        try:
+            return self._claim_next(name, channel_id)
+        except Exception:
+            # Give up the row lock, or on SQLite the write lock, taken for the claim
+            self._db.connection.rollback()
+            raise
+
+    def _claim_next(self, name, channel_id):
+        now = time.time()
+        select = ("select message_id,body,properties,state,redelivered,processing_id from Work_Queue "
+                  "where queue=%s and available_at<=%s and (state='ready' or (state='claimed' and lease_expires<%s)) "
+                  "order by priority desc,message_id limit 1")
+        if self._db.DIALECT == "mysql":
+            select += " for update skip locked"
+        else:
+            # SQLite has no row locks, claims are serialised by taking the write lock first
+            self._db.execute_query("begin immediate")
+        self._db.execute_query(select, (name, now, now))
+        row = self._db.cursor.fetchone()
+        if row is None:
+            self._db.connection.commit()
+            return None
+        message_id, body, properties, state, redelivered, processing_id = row
+        redelivered = bool(redelivered) or state == "claimed"
+        self._db.execute_query("update Work_Queue set state='claimed',lease_owner=%s,lease_expires=%s,redelivered=%s "
+                               "where message_id=%s", (self._owner, now+self._lease, int(redelivered), message_id))
+        self._set_processing_status(processing_id, "enqueued", "claimed")
+        self._db.connection.commit()
+        if state == "claimed":
+            log.warning("Lease on message {} of queue '{}' ran out, delivering it again".format(message_id, name))
+        self._claimed[message_id] = (channel_id, processing_id)
+        return message_id, bytes(body), json.loads(properties or "{}"), redelivered
+
+    def get(self, name, channel_id, timeout=0):
+        """
+        Claim the next ready message of a queue, waiting up to timeout seconds.
+
+        @return (delivery_tag, body, properties, redelivered) or None
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            if timeout or now - self._last_empty.get(name, 0) >= POLL_INTERVAL:
+                result = self._call(self._claim, name, channel_id)
+                if result is not None:
+                    return result
+                self._last_empty[name] = now
+            if now >= deadline:
+                return None
+            time.sleep(min(deadline-now, POLL_INTERVAL))
+
+    def _release(self, message_id, requeue):
+        channel_id, processing_id = self._claimed.pop(message_id, (None, None))
+        try:
+            if requeue:
+                self._db.execute_query("update Work_Queue set state='ready',lease_owner=null,lease_expires=null,redelivered=1 "
+                                       "where message_id=%s and lease_owner=%s", (message_id, self._owner))
+            else:
+                self._db.execute_query("delete from Work_Queue where message_id=%s and lease_owner=%s",
+                                       (message_id, self._owner))
+            # A handler that ran has moved the processing on from 'claimed'; one that
+            # skipped the message has not, so the processing would otherwise stay claimed
+            self._set_processing_status(processing_id, "claimed", "enqueued")
+            self._db.connection.commit()
+        except Exception:
+            self._db.connection.rollback()
+            raise
+
+    def ack(self, delivery_tag):
+        self._call(self._release, delivery_tag, False)
+
+    def reject(self, delivery_tag, requeue=True):
+        self._call(self._release, delivery_tag, requeue)
+
+    def close_channel(self, channel_id):
+        """Make every message still claimed through a channel ready again, and close the broker with its last channel."""
+        for message_id, (owner, processing_id) in list(self._claimed.items()):
+            if owner == channel_id:
+                self._call(self._release, message_id, True)
+        self._channels.discard(channel_id)
+        if not self._channels:
+            self._closed.set()
+            self._db.close()
+
+    def purge(self, name):
+        return self._call(self._db.execute_update, "delete from Work_Queue where queue=%s and state='ready'", (name,))
+
+    def _count(self, name):
+        self._db.execute_query("select count(*) from Work_Queue where queue=%s and state='ready' and available_at<=%s",
+                               (name, time.time()))
+        count = self._db.cursor.fetchone()[0]
+        # End the transaction, or MySQL keeps answering from its snapshot
+        self._db.connection.commit()
+        return count
+
+    def message_count(self, name):
+        return self._call(self._count, name)
+
+    def _stats(self):
+        self._db.execute_query("select queue,state,count(*) from Work_Queue group by queue,state")
+        stats = {}
+        for name, state, count in self._db.cursor.fetchall():
+            stats.setdefault(name, {"ready": 0, "claimed": 0})[state] = count
+        self._db.connection.commit()
+        return stats
+
+    def stats(self):
+        """
+        @return dictionary per queue of the number of messages ready, including
+                those still waiting out a delay, and claimed
+        """
+        return self._call(self._stats)
+
+
+def connect(db_factory, lease=LEASE_SECONDS):
+    """
+    Open a connection to the queues kept in a Trapum database.
+
+    @params db_factory  callable returning a new TrapumDataBase, whose
+                        schema includes the Work_Queue table
+    @params lease       seconds a claim lasts without being renewed
+    """
+    return memory_broker.MemoryConnection(DatabaseBroker(db_factory, lease))
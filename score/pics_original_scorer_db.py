@@ -8,6 +8,7 @@ import trapum_db_score
 import tarfile
 import os
 import pika_process
+import db_broker
 import json
 from datetime import datetime
 import subprocess
@@ -22,6 +23,12 @@ def make_tarfile(output_path,input_path,name):
     with tarfile.open(output_path+'/'+name, "w:gz") as tar:
         tar.add(input_path, arcname= name)
 
+def connect_trapum():
+    # TRAPUM_DB_DSN, e.g. sqlite:///trapum.db, selects a database other than the server below
+    if os.environ.get("TRAPUM_DB_DSN"):
+        return trapum_db_score.open_database(os.environ["TRAPUM_DB_DSN"])
+    return trapum_db_score.TrapumDataBase("db_host_ip","db_port","db_name","user","passwd")
+
 
 def extract_and_score(opts,info):
     # Load model
@@ -32,71 +39,60 @@ def extract_and_score(opts,info):
     pfdfile = glob.glob('%s/*.pfd'%(info["input_path"]))
     log.info("Retrieved pfd files from %s"%(info["input_path"]))
         
-    #Setup database connection
-    log.debug("Connecting to TrapumDB...")
+    #Setup database connection (pooled, connects on first use)
+    trapum = connect_trapum()
     try:
-        trapum = trapum_db_score.TrapumDataBase("db_host_ip","db_port","db_name","user","passwd");
-        t =trapum.connect()
-    except:
-        log.error("DB connection failed")
-        pass
-    log.debug("Connected to TrapumDB")
-
-    #Get pipeline ID 
-    pipeline_id = trapum.get_pipeline_id_from_name("PICS_Original")
-
-    # Create Processing
-    #submit_time = str(datetime.now())
-    #processing_id = trapum.create_processing(pipeline_id,submit_time,"queued")
+        #Get pipeline ID 
+        pipeline_id = trapum.get_pipeline_id_from_name("PICS_Original")
 
-    # Get processing
-    processing_id = info["processing_id"]
+        # Create Processing
+        #submit_time = str(datetime.now())
+        #processing_id = trapum.create_processing(pipeline_id,submit_time,"queued")
 
-    # Create_processing_pivot_entries
-    dp_id = info["dp_id"]
-    pp_id = trapum.create_pivot(dp_id,processing_id)
+        # Get processing
+        processing_id = info["processing_id"]
 
-    # Start time update
-    start_time = str(datetime.now())
-    trapum.update_start_time(start_time,processing_id)
+        # Create_processing_pivot_entries
+        dp_id = info["dp_id"]
+        pp_id = trapum.create_pivot(dp_id,processing_id)
 
+        # Start, end time and status update
+        with trapum.processing_lifecycle(processing_id):
 
-    AI_scores = classifier.report_score([pfdreader(f) for f in pfdfile])
-    log.info("Scored with model %s"%info["model"])
+            AI_scores = classifier.report_score([pfdreader(f) for f in pfdfile])
+            log.info("Scored with model %s"%info["model"])
 
-    # Sort based on highest score
-    pfdfile_sorted = [x for _,x in sorted(zip(AI_scores,pfdfile),reverse=True)]
-    AI_scores_sorted = sorted(AI_scores,reverse=True)
-    log.info("Sorted scores..")
+            # Sort based on highest score
+            pfdfile_sorted = [x for _,x in sorted(zip(AI_scores,pfdfile),reverse=True)]
+            AI_scores_sorted = sorted(AI_scores,reverse=True)
+            log.info("Sorted scores..")
 
-    text = '\n'.join(['%s %s' % (pfdfile_sorted[i], AI_scores_sorted[i]) for i in range(len(pfdfile))])
+            text = '\n'.join(['%s %s' % (pfdfile_sorted[i], AI_scores_sorted[i]) for i in range(len(pfdfile))])
 
-    fout = open('%s/pics_original_descending_scores.txt'%info["input_path"],'w')
-    fout.write(text)
-    log.info("Written to file in %s"%info["input_path"])
-    fout.close()
+            fout = open('%s/pics_original_descending_scores.txt'%info["input_path"],'w')
+            fout.write(text)
+            log.info("Written to file in %s"%info["input_path"])
+            fout.close()
 
-    # End time update
-    end_time = str(datetime.now())
-    trapum.update_end_time(end_time,processing_id)
-    trapum.update_processing_status("Successful",processing_id)
 
-
-    #tar all files in this directory
-    tar_name = os.path.basename(info["input_path"])+"_presto_cands.tar"
-    make_tarfile(info["input_path"],info["input_path"],tar_name)
+        #tar all files in this directory
+        tar_name = os.path.basename(info["input_path"])+"_presto_cands.tar"
+        make_tarfile(info["input_path"],info["input_path"],tar_name)
 
     
-    # Get pointing and beam id from one of the dp_ids
-    try:
-        pb_list = trapum.get_pb_from_dp(dp_id)
-    except Exception as error:
-        log.error(error)
+        # Get pointing and beam id from one of the dp_ids
+        try:
+            pb_list = trapum.get_pb_from_dp(dp_id)
+        except Exception as error:
+            log.error(error)
 
 
-    # Update Dataproducts with pics output entry and tarred files
-    dp_id = trapum.create_secondary_dataproduct(pb_list[0],pb_list[1],processing_id,1,"pics_original_descending_scores.txt",str(info["input_path"]),12)
-    dp_id = trapum.create_secondary_dataproduct(pb_list[0],pb_list[1],processing_id,1,str(tar_name),str(info["input_path"]),11)
+        # Update Dataproducts with pics output entry and tarred files
+        trapum.create_secondary_dataproducts([(pb_list[0],pb_list[1],processing_id,1,"pics_original_descending_scores.txt",str(info["input_path"]),12),
+                                              (pb_list[0],pb_list[1],processing_id,1,str(tar_name),str(info["input_path"]),11)])
+    finally:
+        # Give the connection back to the pool now rather than when this frame is collected
+        trapum.close()
 
 
     # Remove original files 
@@ -104,8 +100,7 @@ def extract_and_score(opts,info):
   
 
 def receive_message(message,opts):
-    global info
-    info = json.loads(message.decode("utf=8"))
+    info = pika_process.decode_message(message, "score")
     extract_and_score(opts,info)
 
 
@@ -129,9 +124,15 @@ if __name__=='__main__':
     #Configure log setup
     log_type = opts.log_level
     log.setLevel(log_type.upper())
+    logging.getLogger('trapum_db').setLevel(log_type.upper())
 
 
     #Consume message from RabbitMQ 
+    # --transport db keeps the queues in the database instead of RabbitMQ
+    pika_process.register_transport("db",lambda url,parameters: db_broker.connect(connect_trapum))
+
     processor = pika_process.pika_process_from_opts(opts)
-    processor.process(lambda message: receive_message(message,opts))
+    # Serve the database statement timings with the other metrics and log the database share of each message
+    processor.add_metrics_collector(trapum_db_score.query_stats.render)
+    processor.process(trapum_db_score.query_stats.timed(lambda message: receive_message(message,opts),"score"))
 
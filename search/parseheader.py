@@ -5,70 +5,103 @@ import numpy as np
 import HeaderParams as conf
 from datetime import datetime
 import struct
+import concurrent.futures
 from struct import unpack
 from os.path import splitext
 
 
-def _read_char(f):
-    return unpack(b"b",f.read(1))[0]
+# Bytes read from the start of a file in one go, enough for any usual header
+HEADER_BLOCK = 65536
 
-def _read_string(f):
-    strlen = unpack(b"I",f.read(4))[0]
-    return f.read(strlen).decode("utf-8")
+_INT = struct.Struct(b"I")
+_struct_of = {"I": _INT, "b": struct.Struct(b"b"), "d": struct.Struct(b"d")}
+# Header keys as they appear in the file, mapped to their name and type
+_keys = dict((key.encode("utf-8"), (key, kind)) for key, kind in conf.header_keys.items())
+_longest_key = max(len(key) for key in _keys)
 
-def _read_int(f):
-    return unpack(b"I",f.read(4))[0]
 
-def _read_double(f):
-    return unpack(b"d",f.read(8))[0]
+class _TruncatedHeader(Exception):
+    pass
+
+
+def _decode_header(data):
+    """Decode the header at the start of data, raising _TruncatedHeader if it runs past the end.
+
+    @return: (header, hdrlen), or (None, None) for an unrecognised key
+    """
+    view = memoryview(data)
+    size = len(data)
+    header = {}
+    offset = 0
+    try:
+        while True:
+            keylen = _INT.unpack_from(view, offset)[0]
+            offset += 4
+            if keylen > _longest_key:
+                key = None
+            else:
+                if offset+keylen > size:
+                    raise _TruncatedHeader()
+                key = view[offset:offset+keylen].tobytes()
+                offset += keylen
+            if key not in _keys:
+                print("'%s' not recognised header key"%(key.decode("utf-8", "replace") if key else "?"))
+                return None, None
+            name, kind = _keys[key]
+            if kind == "str":
+                strlen = _INT.unpack_from(view, offset)[0]
+                offset += 4
+                if offset+strlen > size:
+                    raise _TruncatedHeader()
+                header[name] = view[offset:offset+strlen].tobytes().decode("utf-8")
+                offset += strlen
+            elif kind is not None:
+                header[name] = _struct_of[kind].unpack_from(view, offset)[0]
+                offset += _struct_of[kind].size
+            if name == "HEADER_END":
+                return header, offset
+    except struct.error:
+        raise _TruncatedHeader()
 
 
 def parseSigprocHeader(filename):
     """Parse the metadata from a Sigproc-style file header.
 
+    The first HEADER_BLOCK bytes are read at once and decoded in memory,
+    more is only read for a longer header, and the file length comes from
+    a stat, so that parsing costs one read on network file systems.
+
     @params filename: file containing the header
     :type filename: :func:`str`
     
     @return: observational metadata
     :rtype:  Dictionary
     """
-    #f = open(filename,"r",encoding="utf-8")
-    f = open(filename,"rb",)
-    header = {}
-    try:
-        keylen = unpack(b"I",f.read(4))[0]
-    except struct.error:
-        raise IOError("File Header is not in sigproc format... Is file empty?")
-    key = f.read(keylen)
-    if key != b"HEADER_START":
-        raise IOError("File Header is not in sigproc format")
-    while True:
-        keylen = unpack(b"I",f.read(4))[0]
-        key = f.read(keylen).decode("utf-8")
-        if not key in conf.header_keys:
-            print("'%s' not recognised header key")%(key)
+    with open(filename, "rb", 0) as f:
+        data = f.read(HEADER_BLOCK)
+        if len(data) < 4:
+            raise IOError("File Header is not in sigproc format... Is file empty?")
+        if _INT.unpack_from(data)[0] != 12 or data[4:16] != b"HEADER_START":
+            raise IOError("File Header is not in sigproc format")
+        while True:
+            try:
+                header, hdrlen = _decode_header(data)
+                break
+            except _TruncatedHeader:
+                more = f.read(max(HEADER_BLOCK, len(data)))
+                if not more:
+                    raise IOError("File Header of %s ends before HEADER_END"%(filename))
+                data += more
+        if header is None:
             return None
+        filelen = os.fstat(f.fileno()).st_size
 
-        if conf.header_keys[key] == "str":
-            header[key] = _read_string(f)
-        elif conf.header_keys[key] == "I":
-            header[key] = _read_int(f)
-        elif conf.header_keys[key] == "b":
-            header[key] = _read_char(f)
-        elif conf.header_keys[key] == "d":
-            header[key] = _read_double(f)
-        if key == "HEADER_END":
-            break
-
-    header["hdrlen"] = f.tell()
-    f.seek(0,2)
-    header["filelen"]  = f.tell()
+    header["hdrlen"] = hdrlen
+    header["filelen"]  = filelen
     header["nbytes"] =  header["filelen"]-header["hdrlen"]
     header["nsamples"] = 8*header["nbytes"]/header["nbits"]/header["nchans"]
-    f.seek(0)
     header["filename"] = filename
     header["basename"] = os.path.splitext(filename)[0]
-    f.close()
     return header
 
 def radec_to_str(val):
@@ -88,7 +121,8 @@ def radec_to_str(val):
     yy = ((integral-(integral%100))/100)-xx*100
     zz = integral - 100*yy - 10000*xx + fractional
     zz = "%07.4f"%(zz)
-    return "%02d:%02d:%s"%(sign*xx,yy,zz)
+    # The sign goes on the string, a degree of zero would lose it
+    return "%s%02d:%02d:%s"%("-" if sign < 0 else "",xx,yy,zz)
 
 def MJD_to_Gregorian(mjd):
     """Convert Modified Julian Date to the Gregorian calender.
@@ -102,18 +136,19 @@ def MJD_to_Gregorian(mjd):
     mm = np.fmod(hh,1)*60.
     ss = np.fmod(mm,1)*60.
     ss = "%08.5f"%(ss)
-    j = mjd+2400000.5
+    # Julian day number of the day, which starts at noon
+    j = mjd+2400001
     j = int(j)
     j = j - 1721119
-    y = (4 * j - 1) / 146097
+    y = (4 * j - 1) // 146097
     j = 4 * j - 1 - 146097 * y
-    d = j / 4
-    j = (4 * d + 3) / 1461
+    d = j // 4
+    j = (4 * d + 3) // 1461
     d = 4 * d + 3 - 1461 * j
-    d = (d + 4) / 4
-    m = (5 * d - 3) / 153
+    d = (d + 4) // 4
+    m = (5 * d - 3) // 153
     d = 5 * d - 3 - 153 * m
-    d = (d + 5) / 5
+    d = (d + 5) // 5
     y = 100 * y + j
     if m < 10:
         m = m + 3
@@ -224,6 +259,126 @@ def updateHeader(header):
 
 
 
+def _parse_or_none(filename):
+    try:
+        return parseSigprocHeader(filename)
+    except IOError as error:
+        print("Could not parse the header of %s: %s"%(filename,error))
+        return None
+
+def _column(values, valid):
+    """Make an array of one header field, NaN or None where a file lacks it."""
+    present = [v for v, ok in zip(values, valid) if ok and v is not None]
+    if present and all(isinstance(v, str) for v in present):
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+    if len(present) == len(values) and all(isinstance(v, (int, np.integer)) for v in present):
+        return np.array(values, dtype=np.int64)
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+def _strings(values, valid):
+    column = np.empty(len(valid), dtype=object)
+    column[:] = list(values)
+    column[~valid] = None
+    return column
+
+def _join(*parts):
+    joined = parts[0]
+    for part in parts[1:]:
+        joined = np.char.add(joined, part)
+    return joined
+
+def _radec_columns(val, valid):
+    """Vectorised radec_to_str followed by ra_to_rad or dec_to_rad, without the pi/12 or pi/180 factor.
+
+    @return: (strings, value in seconds of time or of arc)
+    """
+    # Rows without a header are formatted as zero and blanked afterwards
+    val = np.where(valid, val, 0.0)
+    sign = np.where(val < 0, -1.0, 1.0)
+    fractional, integral = np.modf(np.abs(val))
+    xx = (integral-(integral%10000))/10000
+    yy = ((integral-(integral%100))/100)-xx*100
+    zz = np.char.mod("%07.4f", integral - 100*yy - 10000*xx + fractional)
+    strings = _join(np.where(sign < 0, "-", ""), np.char.mod("%02d:", xx), np.char.mod("%02d:", yy), zz)
+    seconds = sign*(60.0*(60.0*xx + yy) + zz.astype(np.float64))
+    return _strings(strings, valid), np.where(valid, seconds, np.nan)
+
+def _mjd_columns(mjd, valid):
+    """Vectorised MJD_to_Gregorian, as arrays of date and time strings."""
+    mjd = np.where(valid, mjd, 0.0)
+    days = np.floor(mjd)
+    dates = np.datetime64("1858-11-17", "D") + days.astype(np.int64).astype("timedelta64[D]")
+    years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+    months = dates.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    mdays = (dates - dates.astype("datetime64[M]")).astype(np.int64) + 1
+    hh = np.fmod(mjd,1)*24.
+    mm = np.fmod(hh,1)*60.
+    ss = np.fmod(mm,1)*60.
+    obs_date = _join(np.char.mod("%02d/", mdays), np.char.mod("%02d/", months), np.char.mod("%02d", years))
+    obs_time = _join(np.char.mod("%02d:", hh), np.char.mod("%02d:", mm), np.char.mod("%08.5f", ss))
+    return _strings(obs_date, valid), _strings(obs_time, valid)
+
+def scan_headers(paths, workers=16):
+    """Parse the headers of many files at once into a table of columns.
+
+    Headers are read by a pool of threads, so that the reads of a network
+    file system overlap, and the quantities updateHeader derives are then
+    computed for all files together with numpy.
+
+    @params paths: files containing the headers
+    @params workers: number of threads reading headers
+
+    @return: dictionary of field to numpy array with one row per path, in
+             the order given. Rows of files whose header could not be
+             parsed are False in "valid", NaN in numeric and None in other
+             columns. Other integer fields are int64 when every file has
+             them and float64 otherwise.
+    :rtype:  Dictionary
+    """
+    paths = list(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        headers = list(executor.map(_parse_or_none, paths))
+    valid = np.array([header is not None for header in headers], dtype=bool)
+    headers = [header or {} for header in headers]
+    fields = []
+    for header in headers:
+        fields.extend(key for key in header if key not in fields)
+
+    table = {"valid": valid}
+    for key in fields:
+        table[key] = _column([header.get(key) for header in headers], valid)
+    table["filename"] = _strings(paths, valid)
+    table["basename"] = _strings([splitext(path)[0] for path in paths], valid)
+    table["extension"] = _strings([splitext(path)[1] for path in paths], valid)
+
+    if "foff" in table and "nchans" in table and "fch1" in table:
+        table["bandwidth"] = np.abs(table["foff"])*table["nchans"]
+        table["ftop"] = table["fch1"] - 0.5*table["foff"]
+        table["fbottom"] = table["ftop"] + table["foff"]*table["nchans"]
+        table["fcenter"] = table["ftop"] + 0.5*table["foff"]*table["nchans"]
+        table["tobs"] = table["tsamp"]*table["nsamples"]
+        for key in ("src_raj", "src_dej"):
+            column = np.asarray(table.get(key, np.zeros(len(paths))), dtype=np.float64)
+            table[key] = np.where(valid & np.isnan(column), 0.0, column)
+        table["ra"], ra_seconds = _radec_columns(table["src_raj"], valid)
+        table["dec"], dec_seconds = _radec_columns(table["src_dej"], valid)
+        table["ra_rad"] = ra_seconds*np.pi/12/60./60.
+        table["dec_rad"] = dec_seconds*np.pi/180/60./60.
+        table["ra_deg"] = table["ra_rad"]*180./np.pi
+        table["dec_deg"] = table["dec_rad"]*180./np.pi
+
+    if "tstart" in table:
+        table["obs_date"], table["obs_time"] = _mjd_columns(table["tstart"], valid)
+
+    if "nbits" in table:
+        table["dtype"] = _strings([conf.nbits_to_dtype.get(nbits) for nbits in table["nbits"]], valid)
+
+    return table
+
+
+
 if __name__=='__main__':
 
 
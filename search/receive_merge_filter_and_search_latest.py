@@ -1,5 +1,6 @@
 import optparse
 import pika_process
+import db_broker
 import parseheader
 import json
 import logging
@@ -19,6 +20,15 @@ log = logging.getLogger('peasoup_search_send')
 FORMAT = "[%(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s"
 logging.basicConfig(format=FORMAT)
 
+def connect_trapum():
+    # TRAPUM_DB_DSN, e.g. sqlite:///trapum.db, selects a database other than the server below
+    if os.environ.get("TRAPUM_DB_DSN"):
+        return trapum_db_search.open_database(os.environ["TRAPUM_DB_DSN"])
+    return trapum_db_search.TrapumDataBase("db_ip","db_port","db_name","db_user","db_passwd")
+
+# Writes database updates the search does not wait on in the background, set up in main
+db_writer = None
+
 #constants##
 T = 4.925e-6 # in seconds
 c = 2.99792458e8 # in m/s
@@ -132,61 +142,46 @@ def call_peasoup(opts,info):
 
     #print(info)
 
-    log.debug("Connecting to TrapumDB...")
+    # Setup database connection (pooled, connects on first use)
+    trapum = connect_trapum()
     try:
-        trapum = trapum_db_search.TrapumDataBase("db_ip","db_port","db_name","db_user","db_passwd");
-        con = trapum.connect()
-        log.info("Connected to TrapumDB")
-    except:
-        pass    # !!! Need to decide what to do when DB fails
-
-
-    processing_id = info["processing_id"]
+        processing_id = info["processing_id"]
 
     
-    # Create_processing_pivot_entries
-    dp_ids = info["dp_ids"]
-    pp_ids=[]
-    for dp_id in dp_ids:
-        pp_id = trapum.create_pivot(dp_id,processing_id)
-        pp_ids.append(pp_id)
-
-    # Start time update to db, change process status to searching...
-    log.info("Starting peasoup search..")
-    print(peasoup_script)
-    try:
-        start_time = str(datetime.now())
-        trapum.update_start_time(start_time,processing_id)
-        subprocess.check_call(peasoup_script,shell=True)
-        end_time = str(datetime.now())
-        trapum.update_processing_status("Successful",processing_id)
-        trapum.update_end_time(end_time,processing_id)
-                
-    except Exception as error:
-        #time.sleep(100)
-        trapum.update_processing_status("Failed",processing_id)
-        trapum.update_processing_notes(str(error).replace("'",""),processing_id)
-        log.error(error)
+        # Create_processing_pivot_entries
+        dp_ids = info["dp_ids"]
+        db_writer.submit("create_pivots",dp_ids,processing_id)
 
-    # Get pointing and beam id from one of the dp_ids
-    try:
-        pb_list = trapum.get_pb_from_dp(dp_id)
-    except:
-        time.sleep(100)
+        # Get pointing and beam id from one of the dp_ids. Looked up before the
+        # search so that a database outage fails the message, to be retried,
+        # rather than the search output going unrecorded
+        pb_list = trapum.get_pb_from_dp(dp_ids[-1])
 
-    # Update Dataproducts with peasoup output entry
-    dp_id = trapum.create_secondary_dataproduct(pb_list[0],pb_list[1],processing_id,1,"overview.xml",str(o_path),8)
+        # Start time update to db, change process status to searching...
+        log.info("Starting peasoup search..")
+        print(peasoup_script)
+        try:
+            with trapum.processing_lifecycle(processing_id,writer=db_writer):
+                subprocess.check_call(peasoup_script,shell=True)
+        except Exception as error:
+            log.error(error)
 
+        # Update Dataproducts with peasoup output entry
+        db_writer.submit("create_secondary_dataproducts",[(pb_list[0],pb_list[1],processing_id,1,"overview.xml",str(o_path),8)])
 
-    # Create a folding processing 
 
-    # Get pipeline ID
-    pipeline_id = trapum.get_pipeline_id_from_name("PRESTO")
+        # Create a folding processing 
 
-    # create Processing
+        # Get pipeline ID
+        pipeline_id = trapum.get_pipeline_id_from_name("PRESTO")
 
-    submit_time = str(datetime.now())
-    fold_processing_id = trapum.create_processing(pipeline_id,submit_time,"enqueued")
+        # create Processing
+
+        submit_time = str(datetime.now())
+        fold_processing_id = trapum.create_processing(pipeline_id,submit_time,"enqueued")
+    finally:
+        # Give the connection back to the pool now rather than when this frame is collected
+        trapum.close()
 
 
     # Create folding packet to publish
@@ -223,7 +218,7 @@ def call_peasoup(opts,info):
     # Publish to Rabbit
     log.debug("Ready to publish to RabbitMQ")
     opts.queue = "presto_folding_Ter5_all_beams"
-    pika_process.publish_info(opts,folding_info)
+    pika_process.publish_info(opts,folding_info,"fold")
    
     # end time update to db, change process status to search done and to be folded
     #log.info("peasoup search complete for %s"%info["input_name"])
@@ -288,7 +283,7 @@ def decide_dm_and_splits(info,opts):
 def receive_and_make_peasoup_args(message,opts):
 
     #global info
-    info = json.loads(message.decode("utf=8"))
+    info = pika_process.decode_message(message, "search")
 
     # Merge filterbanks
     merge_filterbanks(info,opts)
@@ -368,13 +363,23 @@ if __name__=='__main__':
     parser.add_option('--segment_lengths',type=str,help='segment lengths to search over full file',dest="segs",default="10,20")
     parser.add_option('--dm_segments',type=int,help='number of dm segments (RAM limited)',dest="dm_segs",default=10)
     parser.add_option('--companion_mass',type=float,help='Companion mass in solar masses',dest="mc",default=4.0)
+    parser.add_option('--db_journal',type=str,help='file to spool database updates to while the database is unreachable',dest="db_journal",default="trapum_db_journal_search.jsonl")
     opts,args = parser.parse_args()
 
     # Setup logging config
     log_type = opts.log_level
     log.setLevel(log_type.upper())
+    logging.getLogger('trapum_db').setLevel(log_type.upper())
+
+    # Database updates are applied in the background, replaying any spooled ones first
+    db_writer = trapum_db_search.WriteBehindJournal(connect_trapum,opts.db_journal)
 
     # Consume message from RabbitMQ
+    # --transport db keeps the queues in the database instead of RabbitMQ
+    pika_process.register_transport("db",lambda url,parameters: db_broker.connect(connect_trapum))
+
     processor = pika_process.pika_process_from_opts(opts)
-    processor.process(lambda message: receive_and_make_peasoup_args(message,opts))
+    # Serve the database statement timings with the other metrics and log the database share of each message
+    processor.add_metrics_collector(trapum_db_search.query_stats.render)
+    processor.process(trapum_db_search.query_stats.timed(lambda message: receive_and_make_peasoup_args(message,opts),"search"))
 
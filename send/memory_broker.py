@@ -0,0 +1,473 @@
+import sys
+import time
+import heapq
+import itertools
+import threading
+import logging
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+from multiprocessing.managers import BaseManager
+
+
+log = logging.getLogger('memory_broker')
+FORMAT = "[%(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s"
+logging.basicConfig(format=FORMAT)
+
+DEFAULT_AUTHKEY = b"trapum"
+
+# AMQP basic properties carried with every message
+PROPERTY_NAMES = ("content_type", "content_encoding", "headers", "delivery_mode",
+                  "priority", "correlation_id", "reply_to", "expiration",
+                  "message_id", "timestamp", "type", "user_id", "app_id")
+
+
+class ConnectionLost(Exception):
+    """Raised when the (possibly remote) broker can no longer be reached."""
+    pass
+
+
+class Properties(object):
+    """Stand-in for pika.BasicProperties on messages read from the broker."""
+    def __init__(self, **kwargs):
+        for name in PROPERTY_NAMES:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return "<Properties {}>".format({name: getattr(self, name) for name in PROPERTY_NAMES
+                                          if getattr(self, name) is not None})
+
+
+class Method(object):
+    """Stand-in for pika method frames such as Basic.GetOk or Queue.DeclareOk."""
+    def __init__(self, name, **fields):
+        self.NAME = name
+        self.__dict__.update(fields)
+
+
+class Frame(object):
+    """Stand-in for the pika frame returned by queue_declare and queue_purge."""
+    def __init__(self, method):
+        self.method = method
+
+
+def _properties_to_dict(properties):
+    if properties is None:
+        return {}
+    return {name: getattr(properties, name, None) for name in PROPERTY_NAMES
+            if getattr(properties, name, None) is not None}
+
+
+class _Queue(object):
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = dict(arguments or {})
+        self.max_priority = self.arguments.get("x-max-priority", 0)
+        self.ttl = self.arguments.get("x-message-ttl")
+        self.messages = []
+        self.published = 0
+        self.delivered = 0
+        self.wait_time = 0.0
+
+    def push(self, seq, message):
+        priority = min(message["properties"].get("priority") or 0, self.max_priority)
+        heapq.heappush(self.messages, (-priority, seq, message))
+        self.published += 1
+
+    def pop(self, now):
+        message = heapq.heappop(self.messages)[2]
+        self.delivered += 1
+        self.wait_time += now - message["enqueued"]
+        return message
+
+
+class MemoryBroker(object):
+    """
+    In-process message broker with the queue semantics the pipeline relies
+    on from RabbitMQ: durable named queues on the default exchange, message
+    priorities (x-max-priority), per-queue TTL with dead-lettering
+    (x-message-ttl, x-dead-letter-routing-key) and explicit acknowledgement,
+    with unacknowledged messages requeued when their channel closes.
+
+    The broker is thread safe. It can be shared between processes by
+    serving it with `serve` and connecting with a memory://host:port URL.
+    """
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._queues = {}
+        self._unacked = {}
+        self._seq = itertools.count()
+        self._tags = itertools.count(1)
+        self._channels = itertools.count(1)
+
+    def open_channel(self):
+        return next(self._channels)
+
+    def declare(self, name, arguments=None):
+        with self._lock:
+            if name not in self._queues:
+                log.debug("Declaring queue '{}' with arguments {}".format(name, arguments))
+                self._queues[name] = _Queue(name, arguments)
+            return len(self._queues[name].messages)
+
+    def _enqueue(self, name, message):
+        if name not in self._queues:
+            # As with the AMQP default exchange, unroutable messages are dropped
+            log.warning("Dropping message published to undeclared queue '{}'".format(name))
+            return
+        message["enqueued"] = time.time()
+        self._queues[name].push(next(self._seq), message)
+        self._lock.notify_all()
+
+    def _expire(self, now):
+        for q in list(self._queues.values()):
+            if q.ttl is None:
+                continue
+            while q.messages and q.messages[0][2]["enqueued"] + q.ttl/1000.0 <= now:
+                message = heapq.heappop(q.messages)[2]
+                target = q.arguments.get("x-dead-letter-routing-key")
+                if target is None:
+                    continue
+                headers = dict(message["properties"].get("headers") or {})
+                headers.setdefault("x-death", []).append({"queue": q.name, "reason": "expired"})
+                message["properties"]["headers"] = headers
+                self._enqueue(target, message)
+
+    def publish(self, name, body, properties=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        with self._lock:
+            self._expire(time.time())
+            self._enqueue(name, {"body": body, "properties": dict(properties or {}),
+                                 "redelivered": False})
+
+    def get(self, name, channel_id, timeout=0):
+        """
+        Take the next message from a queue, waiting up to timeout seconds.
+
+        @return (delivery_tag, body, properties, redelivered) or None
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                self._expire(now)
+                q = self._queues.get(name)
+                if q is not None and q.messages:
+                    message = q.pop(now)
+                    tag = next(self._tags)
+                    self._unacked[tag] = (channel_id, name, message)
+                    return tag, message["body"], message["properties"], message["redelivered"]
+                if now >= deadline:
+                    return None
+                self._lock.wait(min(deadline-now, 0.1))
+
+    def ack(self, delivery_tag):
+        with self._lock:
+            self._unacked.pop(delivery_tag, None)
+
+    def reject(self, delivery_tag, requeue=True):
+        with self._lock:
+            entry = self._unacked.pop(delivery_tag, None)
+            if entry is not None and requeue:
+                channel_id, name, message = entry
+                message["redelivered"] = True
+                self._enqueue(name, message)
+
+    def close_channel(self, channel_id):
+        """Requeue every message left unacknowledged by a channel."""
+        with self._lock:
+            for tag, (owner, name, message) in list(self._unacked.items()):
+                if owner == channel_id:
+                    del self._unacked[tag]
+                    message["redelivered"] = True
+                    self._enqueue(name, message)
+
+    def purge(self, name):
+        with self._lock:
+            q = self._queues.get(name)
+            if q is None:
+                return 0
+            count = len(q.messages)
+            q.messages = []
+            return count
+
+    def message_count(self, name):
+        with self._lock:
+            self._expire(time.time())
+            q = self._queues.get(name)
+            return 0 if q is None else len(q.messages)
+
+    def stats(self):
+        """
+        @return dictionary per queue of messages ready, unacknowledged,
+                published and delivered, and the mean time in seconds a
+                delivered message spent waiting in the queue
+        """
+        with self._lock:
+            self._expire(time.time())
+            unacked = {}
+            for owner, name, message in self._unacked.values():
+                unacked[name] = unacked.get(name, 0) + 1
+            return {q.name: {"messages": len(q.messages),
+                             "unacked": unacked.get(q.name, 0),
+                             "published": q.published,
+                             "delivered": q.delivered,
+                             "mean_wait": q.wait_time/q.delivered if q.delivered else 0.0}
+                    for q in self._queues.values()}
+
+
+class MemoryChannel(object):
+    """Subset of the pika BlockingChannel API backed by a MemoryBroker."""
+    def __init__(self, connection, broker):
+        self._connection = connection
+        self._broker = broker
+        self._id = broker.open_channel()
+        self._consumers = []
+        self._consuming = False
+        self._prefetch = 0
+        self._unacked = set()
+        self._transaction = None
+        self.is_open = True
+
+    def _call(self, method, *args):
+        if not self.is_open:
+            raise ConnectionLost("Channel is closed")
+        try:
+            return getattr(self._broker, method)(*args)
+        except (EOFError, OSError) as error:
+            self.is_open = False
+            raise ConnectionLost(str(error))
+
+    def queue_declare(self, queue, durable=False, arguments=None, passive=False, **kwargs):
+        if passive:
+            count = self._call("message_count", queue)
+        else:
+            count = self._call("declare", queue, arguments)
+        return Frame(Method("Queue.DeclareOk", queue=queue, message_count=count, consumer_count=0))
+
+    def queue_purge(self, queue):
+        count = self._call("purge", queue)
+        return Frame(Method("Queue.PurgeOk", message_count=count))
+
+    def confirm_delivery(self):
+        # Publishing to the memory broker is synchronous
+        pass
+
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        self._prefetch = prefetch_count
+
+    def tx_select(self):
+        self._transaction = []
+
+    def tx_commit(self):
+        published, self._transaction = self._transaction or [], []
+        for routing_key, body, properties in published:
+            self._call("publish", routing_key, body, properties)
+
+    def tx_rollback(self):
+        self._transaction = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        if self._transaction is not None:
+            # Held back until tx_commit, like an AMQP transaction
+            self._transaction.append((routing_key, body, _properties_to_dict(properties)))
+            return
+        self._call("publish", routing_key, body, _properties_to_dict(properties))
+
+    def _get(self, queue, timeout=0):
+        result = self._call("get", queue, self._id, timeout)
+        if result is None:
+            return None
+        tag, body, properties, redelivered = result
+        self._unacked.add(tag)
+        return tag, body, Properties(**properties), redelivered
+
+    def basic_get(self, queue, **kwargs):
+        result = self._get(queue)
+        if result is None:
+            return None, None, None
+        tag, body, properties, redelivered = result
+        return Method("Basic.GetOk", delivery_tag=tag, redelivered=redelivered), properties, body
+
+    def _tags_for(self, delivery_tag, multiple):
+        if not multiple:
+            return [delivery_tag]
+        # As in AMQP, multiple with tag 0 covers every outstanding delivery
+        return sorted(tag for tag in self._unacked if delivery_tag == 0 or tag <= delivery_tag)
+
+    def basic_ack(self, delivery_tag=0, multiple=False, **kwargs):
+        for tag in self._tags_for(delivery_tag, multiple):
+            self._unacked.discard(tag)
+            self._call("ack", tag)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True, **kwargs):
+        for tag in self._tags_for(delivery_tag, multiple):
+            self._unacked.discard(tag)
+            self._call("reject", tag, requeue)
+
+    def basic_consume(self, queue, on_message_callback, **kwargs):
+        self._consumers.append((queue, on_message_callback))
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self.is_open:
+            self._connection.process_callbacks()
+            delivered = False
+            for queue, callback in list(self._consumers):
+                if self._prefetch and len(self._unacked) >= self._prefetch:
+                    break
+                result = self._get(queue)
+                if result is not None:
+                    tag, body, properties, redelivered = result
+                    callback(self, Method("Basic.Deliver", delivery_tag=tag, redelivered=redelivered),
+                             properties, body)
+                    delivered = True
+            if not delivered:
+                self._connection.process_data_events(time_limit=0.005)
+
+    def consume(self, queue, inactivity_timeout=None, **kwargs):
+        """
+        Generator yielding (method, properties, body) for each message on
+        the queue, or (None, None, None) after inactivity_timeout seconds
+        without a message.
+        """
+        while self.is_open:
+            timeout = 1.0 if inactivity_timeout is None else inactivity_timeout
+            if self._prefetch and len(self._unacked) >= self._prefetch:
+                time.sleep(timeout)
+                result = None
+            else:
+                result = self._get(queue, timeout)
+            if result is not None:
+                tag, body, properties, redelivered = result
+                yield Method("Basic.Deliver", delivery_tag=tag, redelivered=redelivered), properties, body
+            elif inactivity_timeout is not None:
+                yield None, None, None
+
+    def cancel(self):
+        return 0
+
+    def stop_consuming(self):
+        self._consuming = False
+
+    def close(self):
+        if self.is_open:
+            try:
+                self._broker.close_channel(self._id)
+            except (EOFError, OSError):
+                pass
+        self.is_open = False
+
+
+class MemoryConnection(object):
+    """Subset of the pika BlockingConnection API backed by a MemoryBroker."""
+    def __init__(self, broker):
+        self._broker = broker
+        self._channels = []
+        self._callbacks = queue.Queue()
+        self.is_open = True
+
+    def channel(self):
+        channel = MemoryChannel(self, self._broker)
+        self._channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        if not self.is_open:
+            raise ConnectionLost("Connection is closed")
+        self._callbacks.put(callback)
+
+    def process_callbacks(self):
+        while True:
+            try:
+                callback = self._callbacks.get_nowait()
+            except queue.Empty:
+                return
+            callback()
+
+    def process_data_events(self, time_limit=0):
+        try:
+            callback = self._callbacks.get(timeout=time_limit) if time_limit else self._callbacks.get_nowait()
+        except queue.Empty:
+            return
+        callback()
+        self.process_callbacks()
+
+    def sleep(self, duration):
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            self.process_data_events(time_limit=deadline-time.time())
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+        self.is_open = False
+
+
+_default_broker = None
+_default_broker_lock = threading.Lock()
+
+def default_broker():
+    """Return the broker shared by everything in this process."""
+    global _default_broker
+    with _default_broker_lock:
+        if _default_broker is None:
+            _default_broker = MemoryBroker()
+    return _default_broker
+
+
+class _BrokerManager(BaseManager):
+    pass
+
+_BrokerManager.register("get_broker", callable=default_broker)
+
+
+def _parse_address(url):
+    host, port = url[len("memory://"):].rsplit(":", 1)
+    return host, int(port)
+
+def remote_broker(url, authkey=DEFAULT_AUTHKEY):
+    """Return a proxy to a broker served by another process on memory://host:port."""
+    manager = _BrokerManager(address=_parse_address(url), authkey=authkey)
+    try:
+        manager.connect()
+    except OSError as error:
+        raise ConnectionLost(str(error))
+    return manager.get_broker()
+
+def connect(url="memory"):
+    """
+    Open a connection to a memory broker.
+
+    @params url  "memory" for the broker in this process or
+                 "memory://host:port" for a broker served by `serve`
+    """
+    if url == "memory":
+        return MemoryConnection(default_broker())
+    return MemoryConnection(remote_broker(url))
+
+def serve(url, authkey=DEFAULT_AUTHKEY):
+    """Serve this process's broker to other processes on memory://host:port."""
+    manager = _BrokerManager(address=_parse_address(url), authkey=authkey)
+    log.info("Serving memory broker on {}".format(url))
+    manager.get_server().serve_forever()
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('', '--url', dest='url', type=str,
+                      help='Address to serve the broker on', default="memory://127.0.0.1:5673")
+    parser.add_option('', '--stats', dest='stats', action='store_true',
+                      help='Print queue statistics of the broker served on --url and exit', default=False)
+    parser.add_option('', '--log_level',dest='log_level',type=str,
+                      help='Logging level for memory_broker logger', default="INFO")
+    opts,args = parser.parse_args()
+    log.setLevel(opts.log_level.upper())
+    if opts.stats:
+        for name, stats in sorted(remote_broker(opts.url).stats().items()):
+            print(name, stats)
+        sys.exit(0)
+    serve(opts.url)
@@ -1,21 +1,86 @@
+import os
 import signal
 import sys
 import time
+import functools
+import itertools
+import collections
+import threading
+import atexit
 import pika
 import logging
 import json
+import numbers
+import zlib
+import hashlib
+import sqlite3
 
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import memory_broker
+except ImportError:
+    memory_broker = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import concurrent.futures
+except ImportError:  # Python 2 without the futures backport
+    concurrent = None
 
 
 log = logging.getLogger('pikaprocess')
 FORMAT = "[%(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s"
 logging.basicConfig(format=FORMAT)
 
+# Transports keyed on the scheme of the transport URL, see register_transport
+_transports = {}
+# Exceptions signalling a lost connection on any registered transport
+TRANSPORT_ERRORS = (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError)
+
+def register_transport(scheme, factory, errors=()):
+    """
+    Register a message transport.
+
+    @params scheme   Scheme of the transport URL, e.g. "memory" for "memory://host:port"
+    @params factory  Callable taking (url, pika.ConnectionParameters) and returning a
+                     connection implementing the subset of the pika BlockingConnection
+                     and BlockingChannel API used in this module
+    @params errors   Exception types raised by the transport when its connection is lost
+    """
+    global TRANSPORT_ERRORS
+    _transports[scheme] = factory
+    TRANSPORT_ERRORS = TRANSPORT_ERRORS + tuple(errors)
+
+def _amqp_connection(url, parameters):
+    return pika.BlockingConnection(parameters)
+
+def _memory_connection(url, parameters):
+    return memory_broker.connect(url)
+
+register_transport("amqp", _amqp_connection)
+if memory_broker is not None:
+    register_transport("memory", _memory_connection, (memory_broker.ConnectionLost,))
+
+
 class PikaChannel(object):
-    def __init__(self, host, port, user, password, vhost):
+    def __init__(self, host, port, user, password, vhost, transport="amqp"):
         self._connection = None
         self._channel = None
         self._queues = []
+        self._transport = transport
         self._credentials = pika.PlainCredentials(user, password)
         self._parameters = pika.ConnectionParameters(host, port, vhost, self._credentials)
         
@@ -23,13 +88,25 @@ class PikaChannel(object):
         log.info("Registering queue with options: {}".format(opts))
         self._queues.append(opts)
     
-    def __enter__(self):
-        log.debug("Establishing RabbitMQ connection")
-        self._connection = pika.BlockingConnection(self._parameters)
-        self._channel = self._connection.channel()
+    def connect(self):
+        """Open a new connection with all registered queues declared.
+
+        The caller owns the returned (connection, channel) pair and is
+        responsible for closing the connection.
+        """
+        log.debug("Establishing {} connection".format(self._transport))
+        scheme = self._transport.split("://")[0]
+        if scheme not in _transports:
+            raise ValueError("Unknown transport '{}'".format(self._transport))
+        connection = _transports[scheme](self._transport, self._parameters)
+        channel = connection.channel()
         for queue in self._queues:
             log.debug("Declaring RabbitMQ queue: {}".format(queue))
-            self._channel.queue_declare(**queue)
+            channel.queue_declare(**queue)
+        return connection, channel
+
+    def __enter__(self):
+        self._connection, self._channel = self.connect()
         return self._channel
 
     def __exit__(self, type, value, traceback):
@@ -37,17 +114,500 @@ class PikaChannel(object):
         self._connection.close()
    
 
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, count))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, self.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+
+class ProcessMetrics(object):
+    """
+    Metrics of the message loop in the Prometheus text format:
+
+    - messages handled by outcome (success, retried, dead_lettered, requeued,
+      duplicate)
+    - handler duration histogram
+    - queueing latency histogram, from the x-published-at header (or the
+      AMQP timestamp) stamped by the publisher to the handler starting
+    - worker idle time, i.e. seconds each free worker slot spent waiting
+    - number of polls of an empty input queue
+
+    Other metrics, e.g. of the database, are added with add_collector.
+    """
+    HANDLER_BUCKETS = (1, 10, 60, 300, 900, 1800, 3600, 7200, 14400, 28800)
+    LATENCY_BUCKETS = (0.1, 1, 10, 60, 300, 900, 3600, 14400, 86400)
+
+    def __init__(self, queue_name, concurrency=1):
+        self._lock = threading.Lock()
+        self._labels = 'queue="{}"'.format(queue_name)
+        self._concurrency = concurrency
+        self._messages = collections.defaultdict(int)
+        self._handler_duration = _Histogram(self.HANDLER_BUCKETS)
+        self._queue_latency = _Histogram(self.LATENCY_BUCKETS)
+        self._empty_polls = 0
+        self._inflight = 0
+        self._idle = 0.0
+        self._last_change = time.time()
+        self._collectors = []
+
+    def add_collector(self, render):
+        """Append the text returned by render(), in the Prometheus text format, to every render."""
+        self._collectors.append(render)
+
+    def _tick(self, now):
+        self._idle += (self._concurrency - self._inflight)*(now - self._last_change)
+        self._last_change = now
+
+    def message_started(self, properties):
+        now = time.time()
+        published_at = _message_headers(properties).get("x-published-at") or properties.timestamp
+        with self._lock:
+            self._tick(now)
+            self._inflight += 1
+            if published_at:
+                self._queue_latency.observe(max(0.0, now - published_at))
+
+    def message_finished(self):
+        with self._lock:
+            self._tick(time.time())
+            self._inflight -= 1
+
+    def handler_finished(self, duration):
+        with self._lock:
+            self._handler_duration.observe(duration)
+
+    def count(self, outcome):
+        with self._lock:
+            self._messages[outcome] += 1
+
+    def empty_poll(self):
+        with self._lock:
+            self._empty_polls += 1
+
+    def render(self):
+        with self._lock:
+            self._tick(time.time())
+            lines = ["# HELP pikaprocess_messages_total Messages handled by outcome",
+                     "# TYPE pikaprocess_messages_total counter"]
+            for outcome, count in sorted(self._messages.items()):
+                lines.append('pikaprocess_messages_total{{{},outcome="{}"}} {}'.format(
+                    self._labels, outcome, count))
+            lines += ["# HELP pikaprocess_handler_duration_seconds Time spent in the message handler",
+                      "# TYPE pikaprocess_handler_duration_seconds histogram"]
+            lines += self._handler_duration.render("pikaprocess_handler_duration_seconds", self._labels)
+            lines += ["# HELP pikaprocess_queue_latency_seconds Time from publish to the handler starting",
+                      "# TYPE pikaprocess_queue_latency_seconds histogram"]
+            lines += self._queue_latency.render("pikaprocess_queue_latency_seconds", self._labels)
+            lines += ["# HELP pikaprocess_idle_seconds_total Seconds worker slots spent without a message",
+                      "# TYPE pikaprocess_idle_seconds_total counter",
+                      "pikaprocess_idle_seconds_total{{{}}} {}".format(self._labels, self._idle),
+                      "# HELP pikaprocess_empty_polls_total Polls that found the input queue empty",
+                      "# TYPE pikaprocess_empty_polls_total counter",
+                      "pikaprocess_empty_polls_total{{{}}} {}".format(self._labels, self._empty_polls),
+                      "# HELP pikaprocess_inflight_messages Messages currently being handled",
+                      "# TYPE pikaprocess_inflight_messages gauge",
+                      "pikaprocess_inflight_messages{{{}}} {}".format(self._labels, self._inflight)]
+        text = "\n".join(lines) + "\n"
+        for render in self._collectors:
+            text += render()
+        return text
+
+
+def serve_metrics(metrics, port):
+    """Serve metrics.render() over HTTP from a daemon thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(("", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.info("Serving metrics on port {}".format(port))
+    return server
+
+
+class PermanentFailure(Exception):
+    """
+    Raised by a message handler for failures that will not go away on
+    retry (e.g. a missing input file). The message is dead-lettered
+    straight away regardless of the retry policy.
+    """
+    pass
+
+
+class RetryPolicy(object):
+    """
+    Retry policy for failed messages.
+
+    The attempt number is carried in the 'x-attempt' message header. A
+    failed message is parked in a delay queue whose TTL grows as
+    delay*backoff**(attempt-1) and that dead-letters back onto the input
+    queue once the TTL expires. After max_attempts the message goes to
+    the fail queue with the failure reason in its headers.
+    """
+    def __init__(self, max_attempts=1, delay=60.0, backoff=2.0):
+        self.max_attempts = max(1, max_attempts)
+        self.delay = delay
+        self.backoff = backoff
+
+    def should_retry(self, attempt, error):
+        return attempt < self.max_attempts and not isinstance(error, PermanentFailure)
+
+    def delay_for(self, attempt):
+        return self.delay * self.backoff**(attempt-1)
+
+    def retry_queue_params(self, input_queue, attempt):
+        delay_ms = int(1000*self.delay_for(attempt))
+        return {"queue": "{}.retry.{}ms".format(input_queue, delay_ms), "durable": True,
+                "arguments": {"x-message-ttl": delay_ms,
+                              "x-dead-letter-exchange": "",
+                              "x-dead-letter-routing-key": input_queue}}
+
+
+class InvalidMessage(PermanentFailure):
+    """Raised when a message cannot be decoded or does not match its schema."""
+    pass
+
+
+class MessageSchema(object):
+    """
+    Schema of the packets published to one stage.
+
+    Fields map a name to the accepted types. Required fields must be
+    present on decode, optional ones are type checked when present and
+    unknown fields are passed through untouched. The version is bumped
+    whenever a field is removed or changes meaning; consumers reject
+    packets from a newer version than they understand. Fields listed in
+    per_submission differ between submissions of the same work, e.g. the
+    processing created for each, and are left out of the idempotency key.
+    """
+    def __init__(self, name, version, required, optional=None, per_submission=("processing_id",)):
+        self.name = name
+        self.version = version
+        self.required = required
+        self.optional = optional or {}
+        self.per_submission = tuple(per_submission)
+
+    def validate(self, packet):
+        if not isinstance(packet, dict):
+            raise InvalidMessage("{} packet is a {}, not a dict".format(self.name, type(packet).__name__))
+        missing = [field for field in self.required if field not in packet]
+        if missing:
+            raise InvalidMessage("{} packet is missing {}".format(self.name, ", ".join(sorted(missing))))
+        for fields in (self.required, self.optional):
+            for field, types in fields.items():
+                if field in packet and not isinstance(packet[field], types):
+                    raise InvalidMessage("{} packet field '{}' is a {}, expected {}".format(
+                        self.name, field, type(packet[field]).__name__,
+                        " or ".join(t.__name__ for t in types)))
+        return packet
+
+
+_STRING = (str, type(u""))
+_NUMBER = (numbers.Real,)
+_INTEGER = (numbers.Integral,)
+_LIST = (list, tuple)
+
+# Packets consumed by each stage
+SCHEMAS = {
+    # send -> search: one merged filterbank to make and search
+    "search": MessageSchema("search", 1,
+                            {"script": _STRING, "subgroup_files": _STRING, "dp_ids": _LIST,
+                             "output_path": _STRING, "filename": _STRING, "processing_id": _INTEGER},
+                            {"input_path": _STRING, "start_acc": _NUMBER, "end_acc": _NUMBER}),
+    # search -> fold: peasoup candidates to fold
+    "fold": MessageSchema("fold", 1,
+                          {"subgroup_files": _STRING, "dp_ids": _LIST, "processing_id": _INTEGER,
+                           "xml_path": _STRING, "output_path": _STRING, "batch_number": _INTEGER,
+                           "sub_ints": _INTEGER, "bins": _INTEGER}),
+    # fold -> score: folded candidates to score
+    "score": MessageSchema("score", 1,
+                           {"dp_id": _INTEGER, "processing_id": _INTEGER,
+                            "input_path": _STRING, "model": _STRING},
+                           # Every fold run records its candidates as a new data product
+                           per_submission=("processing_id", "dp_id")),
+}
+
+CODECS = ("json", "msgpack")
+# Prefix of msgpack+zlib encoded messages. JSON messages always start with '{'.
+MSGPACK_PREFIX = b"\x00mpz"
+
+def encode_message(packet, schema=None, codec="json"):
+    """
+    @brief   Encode a packet for publishing
+
+    @params  packet  dictionary to send
+    @params  schema  name of the schema in SCHEMAS to validate against and tag the packet with
+    @params  codec   "json", or "msgpack" for msgpack compressed with zlib
+
+    @return  encoded message
+    """
+    packet = dict(packet)
+    if schema is not None:
+        SCHEMAS[schema].validate(packet)
+        packet["_schema"] = schema
+        packet["_version"] = SCHEMAS[schema].version
+        packet.setdefault("_key", idempotency_key(schema, packet))
+    if codec == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack codec requested but msgpack is not installed")
+        return MSGPACK_PREFIX + zlib.compress(msgpack.packb(packet, use_bin_type=True))
+    elif codec == "json":
+        return json.dumps(packet)
+    raise ValueError("Unknown codec '{}'".format(codec))
+
+def idempotency_key(schema, packet):
+    """
+    @brief   Key identifying the work a packet asks for
+
+    The key covers the stage and its input: the data products, files
+    and parameters of the packet, but not the fields of the schema that
+    differ per submission such as the processing_id. Redeliveries and
+    re-submissions of the same job therefore share a key, so a worker
+    can tell from a CompletionLedger that the work is done.
+
+    @return  "stage:hash of the input fields"
+    """
+    per_submission = SCHEMAS[schema].per_submission if schema in SCHEMAS else ("processing_id",)
+    fields = dict((k, v) for k, v in packet.items() if not k.startswith("_") and k not in per_submission)
+    digest = hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return "{}:{}".format(schema, digest[:16])
+
+def _decode(body):
+    if isinstance(body, type(u"")):
+        body = body.encode("utf-8")
+    try:
+        if body.startswith(MSGPACK_PREFIX):
+            if msgpack is None:
+                raise InvalidMessage("msgpack encoded message but msgpack is not installed")
+            packet = msgpack.unpackb(zlib.decompress(body[len(MSGPACK_PREFIX):]), raw=False)
+        else:
+            packet = json.loads(body.decode("utf-8"))
+    except InvalidMessage:
+        raise
+    except Exception as error:
+        raise InvalidMessage("Could not decode message: {}".format(error))
+    if not isinstance(packet, dict):
+        raise InvalidMessage("Message is a {}, not a dict".format(type(packet).__name__))
+    return packet
+
+def message_key(body):
+    """Idempotency key of a message, or None if it has none or cannot be decoded."""
+    try:
+        return _decode(body).get("_key")
+    except InvalidMessage:
+        return None
+
+def decode_message(body, schema=None):
+    """
+    @brief   Decode and validate a received message
+
+    Messages without a schema tag (published before the codec existed)
+    are taken to be version 1 of the expected schema.
+
+    @params  body    message body as received
+    @params  schema  name of the schema in SCHEMAS the message must match
+
+    @return  packet dictionary, without the schema tag and idempotency key
+
+    @raises  InvalidMessage if the message is malformed or does not match the schema
+    """
+    packet = _decode(body)
+    tag = packet.pop("_schema", schema)
+    version = packet.pop("_version", 1)
+    packet.pop("_key", None)
+    if schema is None:
+        return packet
+    if tag != schema:
+        raise InvalidMessage("Expected a {} packet, received a {} packet".format(schema, tag))
+    if version > SCHEMAS[schema].version:
+        raise InvalidMessage("{} packet version {} is newer than the supported version {}".format(
+            schema, version, SCHEMAS[schema].version))
+    return SCHEMAS[schema].validate(packet)
+
+
+class CompletionLedger(object):
+    """
+    Record of the idempotency keys of successfully handled messages,
+    kept in a local sqlite3 file. Point the workers of a stage on one
+    host at the same file so that a redelivered or re-submitted packet
+    is skipped instead of being processed again.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS completed "
+                             "(key TEXT PRIMARY KEY, completed_at REAL)")
+
+    def is_complete(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM completed WHERE key=?", (key,)).fetchone()
+        return row is not None
+
+    def mark_complete(self, key):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO completed VALUES (?,?)", (key, time.time()))
+
+    def close(self):
+        self._db.close()
+
+
+# Returned by _run_handler in place of an error for already completed messages
+_ALREADY_COMPLETED = object()
+
+
+def stamped_properties(priority=0, headers=None):
+    """Persistent message properties stamped with the publish time."""
+    now = time.time()
+    headers = dict(headers or {})
+    headers["x-published-at"] = now
+    return pika.BasicProperties(delivery_mode = 2, priority=priority, headers=headers,
+                                timestamp=int(now))
+
+def _message_priority(properties):
+    return properties.priority or 0
+
+def _message_headers(properties):
+    return dict(properties.headers or {})
+
+
+class _Future(object):
+    """Result of a call run by a _WorkerPool, with the part of the concurrent.futures.Future API used here."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _set(self, result, exception):
+        self._result, self._exception = result, exception
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+
+    def exception(self):
+        self._done.wait()
+        return self._exception
+
+    def result(self):
+        if self.exception() is not None:
+            raise self._exception
+        return self._result
+
+
+class _WorkerPool(object):
+    """Fixed pool of daemon threads standing in for a ThreadPoolExecutor where concurrent.futures is missing."""
+    def __init__(self, max_workers):
+        self._calls = queue.Queue()
+        for _ in range(max_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            future, fn, args = self._calls.get()
+            try:
+                result = fn(*args)
+            except BaseException as error:
+                future._set(None, error)
+            else:
+                future._set(result, None)
+
+    def submit(self, fn, *args):
+        future = _Future()
+        self._calls.put((future, fn, args))
+        return future
+
+
+def _executor(max_workers):
+    if concurrent is None:
+        return _WorkerPool(max_workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+def _wait(future, timeout):
+    if concurrent is None:
+        future.wait(timeout)
+    else:
+        concurrent.futures.wait([future], timeout=timeout)
+
+
 class PikaProcess(object):
     def __init__(self, host, port, user, pwd, vhost,
                  input_q_params, success_q_params,
-                 fail_q_params, sleep_time=30):
-        self._current = None
-        self._current_priority = 0
+                 fail_q_params, sleep_time=30, consume=False, prefetch=1,
+                 concurrency=1, late_ack=False, retry_policy=None, transport="amqp",
+                 metrics_port=0, ledger=None):
+        # Messages currently being handled, keyed on a per-process sequence
+        # number, with the properties they were received with
+        self._inflight = {}
+        # (channel, delivery_tag) of in-flight messages awaiting a late ack
+        self._unacked = {}
+        self._late_ack = late_ack
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._declared = set()
+        self._sequence = itertools.count()
         self._sleep_time = sleep_time
-        self._channel_manager = PikaChannel(host, port, user, pwd, vhost)
+        self._concurrency = max(1, concurrency)
+        self._consume = consume or self._concurrency > 1
+        self._prefetch = max(prefetch, self._concurrency)
+        self._connection = None
+        self._channel = None
+        self._executor = None
+        self._pending = collections.deque()
+        self._completed = queue.Queue()
+        self._channel_manager = PikaChannel(host, port, user, pwd, vhost, transport)
         self._input_q_params = input_q_params
         self._success_q_params = success_q_params
         self._fail_q_params = fail_q_params
+        self._max_priority = input_q_params.get("arguments", {}).get("x-max-priority", 10)
+        self._metrics = ProcessMetrics(input_q_params["queue"], self._concurrency)
+        self._metrics_port = metrics_port
+        self._ledger = ledger
         self._channel_manager.add_queue(**self._input_q_params)
         self._channel_manager.add_queue(**self._success_q_params)
         self._channel_manager.add_queue(**self._fail_q_params)
@@ -56,10 +616,16 @@ class PikaProcess(object):
         
     def _signal_handler(self, signum, frame):
         log.info("Signal handler called with signal {}".format(signum))
-        if self._current is not None:
-            log.info("Returning current message, '{}', to the input queue with priority {}".format(
-                self._current, self._current_priority+1))
-            self._return_to_input(self._current)
+        for message, properties in list(self._inflight.values()):
+            if self._late_ack:
+                log.info("Leaving current message, '{}', unacknowledged for redelivery".format(message))
+                continue
+            self._return_to_input(message, properties)
+        if self._executor is not None:
+            # Worker threads may be hours into a handler and would block a
+            # normal interpreter exit. Their messages have been returned above.
+            logging.shutdown()
+            os._exit(0)
         sys.exit(0)
             
     def _get_input_message(self):
@@ -71,44 +637,294 @@ class PikaProcess(object):
                     return method_frame, header_frame, body
         return None, None, None
 
-    def _send_success_message(self, message):
-        with self._channel_manager as channel:
-            channel.basic_publish(exchange='', routing_key=self._success_q_params["queue"], body=message,
-                                  properties=pika.BasicProperties(delivery_mode = 2, priority=0))
+    def _basic_publish(self, channel, routing_key, message, properties, queue_params):
+        if queue_params is not None and queue_params["queue"] not in self._declared:
+            channel.queue_declare(**queue_params)
+            self._declared.add(queue_params["queue"])
+        channel.basic_publish(exchange='', routing_key=routing_key, body=message,
+                              properties=properties)
 
-    def _send_fail_message(self, message):
+    def _publish(self, routing_key, message, priority=0, headers=None, queue_params=None):
+        properties = stamped_properties(priority, headers)
+        if self._channel is not None and self._channel.is_open:
+            # Reuse the long-lived consumer channel when there is one
+            try:
+                self._basic_publish(self._channel, routing_key, message, properties, queue_params)
+                return
+            except TRANSPORT_ERRORS:
+                log.warning("Consumer channel unusable, publishing over a new connection")
         with self._channel_manager as channel:
-            channel.basic_publish(exchange='', routing_key=self._fail_q_params["queue"], body=message,
-                                  properties=pika.BasicProperties(delivery_mode = 2, priority=0))
+            self._basic_publish(channel, routing_key, message, properties, queue_params)
+
+    def _send_success_message(self, message):
+        self._publish(self._success_q_params["queue"], message)
+
+    def _send_fail_message(self, message, headers=None):
+        self._publish(self._fail_q_params["queue"], message, headers=headers)
 
-    def _return_to_input(self, message):
+    def _send_retry_message(self, message, properties, attempt):
+        queue_params = self._retry_policy.retry_queue_params(self._input_q_params["queue"], attempt)
+        headers = _message_headers(properties)
+        headers["x-attempt"] = attempt+1
+        log.info("Retrying message in {} seconds (attempt {} of {})".format(
+            self._retry_policy.delay_for(attempt), attempt+1, self._retry_policy.max_attempts))
+        self._publish(queue_params["queue"], message, _message_priority(properties),
+                      headers, queue_params)
+
+    def _dead_letter(self, message, properties, reason):
+        headers = _message_headers(properties)
+        headers["x-failure-reason"] = reason
+        headers["x-failed-at"] = time.time()
+        log.error("Dead-lettering message to '{}': {}".format(self._fail_q_params["queue"], reason))
+        self._send_fail_message(message, headers)
+
+    def _return_to_input(self, message, properties):
+        # Always use a fresh connection here as this may be called from
+        # within a signal handler interrupting the consumer connection
+        headers = _message_headers(properties)
+        headers["x-returns"] = headers.get("x-returns", 0) + 1
+        if self._retry_policy.max_attempts > 1 and headers["x-returns"] > self._retry_policy.max_attempts:
+            # Stop a message that keeps getting its worker killed from
+            # jumping the queue forever
+            headers["x-failure-reason"] = "Returned to the input queue {} times".format(headers["x-returns"]-1)
+            headers["x-failed-at"] = time.time()
+            routing_key, priority = self._fail_q_params["queue"], 0
+            self._metrics.count("dead_lettered")
+            log.error("Dead-lettering current message, '{}', to '{}': {}".format(
+                message, routing_key, headers["x-failure-reason"]))
+        else:
+            routing_key, priority = self._input_q_params["queue"], min(_message_priority(properties)+1, self._max_priority)
+            self._metrics.count("requeued")
+            log.info("Returning current message, '{}', to the input queue with priority {}".format(
+                message, priority))
         with self._channel_manager as channel:
-            channel.basic_publish(exchange='', routing_key=self._input_q_params["queue"], body=message,
-                                  properties=pika.BasicProperties(delivery_mode = 2, priority=self._current_priority+1))
-            
-    def process(self, message_handler):
+            channel.basic_publish(exchange='', routing_key=routing_key, body=message,
+                                  properties=stamped_properties(priority, headers))
+
+    def _run_handler(self, message_handler, message):
+        """Run the handler on one message, returning the error raised or None.
+
+        With a ledger, messages whose idempotency key is already recorded
+        as complete are not handled again.
+        """
+        key = message_key(message) if self._ledger is not None else None
+        if key is not None and self._ledger.is_complete(key):
+            log.info("Message with key '{}' has already been processed, skipping".format(key))
+            return _ALREADY_COMPLETED
+        start = time.time()
+        try:
+            log.info("Calling handler")
+            message_handler(message)
+        except Exception as error:
+            log.exception("Message handler failure")
+            return error
+        else:
+            log.info("Message successfully processed")
+            if key is not None:
+                self._ledger.mark_complete(key)
+            return None
+        finally:
+            self._metrics.handler_finished(time.time() - start)
+
+    def _ack(self, channel, delivery_tag):
+        try:
+            channel.basic_ack(delivery_tag=delivery_tag)
+        except TRANSPORT_ERRORS:
+            log.warning("Could not acknowledge message, it will be redelivered by the broker")
+
+    def _wait_for_handler(self, connection, future):
+        """Wait for a handler to finish, returning the error raised or None.
+
+        pika connections are not thread safe, so rather than heartbeating
+        from a background thread the handler runs in a worker thread while
+        this thread keeps servicing the connection and its heartbeats.
+        """
+        try:
+            while not future.done():
+                connection.process_data_events(time_limit=0)
+                _wait(future, 1)
+        except TRANSPORT_ERRORS:
+            log.exception("Lost RabbitMQ connection while the handler was running")
+        return future.exception() or future.result()
+
+    def _route_result(self, message, properties, error):
+        if error is _ALREADY_COMPLETED:
+            self._metrics.count("duplicate")
+            return
+        if error is None:
+            self._metrics.count("success")
+            self._send_success_message(message)
+            return
+        attempt = _message_headers(properties).get("x-attempt", 1)
+        if self._retry_policy.should_retry(attempt, error):
+            self._metrics.count("retried")
+            self._send_retry_message(message, properties, attempt)
+        else:
+            self._metrics.count("dead_lettered")
+            self._dead_letter(message, properties, "{}: {}".format(type(error).__name__, error))
+
+    def _handle_message(self, message_handler, message, properties):
+        key = next(self._sequence)
+        self._inflight[key] = (message, properties)
+        self._metrics.message_started(properties)
+        log.info("Received message: '{}' with priority {}".format(message, properties.priority))
+        try:
+            self._route_result(message, properties, self._run_handler(message_handler, message))
+        finally:
+            self._inflight.pop(key, None)
+            self._metrics.message_finished()
+
+    def _handle_message_late_ack(self, message_handler, connection, channel,
+                                 method_frame, header_frame, message):
+        key = next(self._sequence)
+        self._inflight[key] = (message, header_frame)
+        self._metrics.message_started(header_frame)
+        log.info("Received message: '{}' with priority {}".format(message, header_frame.priority))
+        try:
+            future = self._executor.submit(self._run_handler, message_handler, message)
+            self._route_result(message, header_frame, self._wait_for_handler(connection, future))
+            self._ack(channel, method_frame.delivery_tag)
+        finally:
+            self._inflight.pop(key, None)
+            self._metrics.message_finished()
+
+    def _on_message(self, message_handler, channel, method, properties, body):
+        log.info("Received message: '{}' with priority {}".format(body, properties.priority))
+        self._pending.append((method.delivery_tag, body, properties))
+        self._dispatch(message_handler)
+
+    def _dispatch(self, message_handler):
+        """Start handlers for pending messages while worker slots are free.
+
+        Messages are acknowledged as a worker picks them up, or once the
+        handler has finished in late_ack mode, so anything still pending is
+        redelivered by the broker if the connection drops.
+        """
+        while self._pending and len(self._inflight) < self._concurrency:
+            delivery_tag, message, properties = self._pending.popleft()
+            key = next(self._sequence)
+            if self._late_ack:
+                self._unacked[key] = (self._channel, delivery_tag)
+            else:
+                self._channel.basic_ack(delivery_tag=delivery_tag)
+            self._inflight[key] = (message, properties)
+            self._metrics.message_started(properties)
+            future = self._executor.submit(self._run_handler, message_handler, message)
+            future.add_done_callback(functools.partial(self._on_handler_done, message_handler, key))
+
+    def _on_handler_done(self, message_handler, key, future):
+        # Runs in the worker thread. pika connections are not thread safe so
+        # the result is handed back to the connection thread for routing.
+        self._completed.put((key, future.exception() or future.result()))
+        connection = self._connection
+        try:
+            connection.add_callback_threadsafe(
+                functools.partial(self._drain_completed, message_handler))
+        except Exception:
+            # Connection is being re-established; results are drained on reconnect
+            pass
+
+    def _drain_completed(self, message_handler):
+        while True:
+            try:
+                key, error = self._completed.get_nowait()
+            except queue.Empty:
+                break
+            message, properties = self._inflight.pop(key)
+            self._metrics.message_finished()
+            self._route_result(message, properties, error)
+            if key in self._unacked:
+                channel, delivery_tag = self._unacked.pop(key)
+                if channel is self._channel:
+                    self._ack(channel, delivery_tag)
+                else:
+                    log.warning("Message was received on a closed channel and will be redelivered")
+        if self._channel is not None:
+            self._dispatch(message_handler)
+
+    def _poll_late_ack(self, message_handler):
+        """Poll for messages, acknowledging each only after it is handled.
+
+        The connection the message was received on is held open, with
+        heartbeats serviced, for as long as the handler runs. If the worker
+        dies the message is redelivered by the broker.
+        """
+        self._executor = _executor(1)
+        while True:
+            connection, channel = self._channel_manager.connect()
+            self._connection, self._channel = connection, channel
+            try:
+                method_frame, header_frame, message = channel.basic_get(queue=self._input_q_params['queue'])
+                if method_frame is not None and method_frame.NAME != 'Basic.GetEmpty':
+                    self._handle_message_late_ack(message_handler, connection, channel,
+                                                  method_frame, header_frame, message)
+                    continue
+                self._metrics.empty_poll()
+            finally:
+                self._connection = None
+                self._channel = None
+                if connection.is_open:
+                    connection.close()
+            log.info("No message received, going to sleep for {} seconds".format(self._sleep_time))
+            time.sleep(self._sleep_time)
+
+    def _poll(self, message_handler):
+        if self._late_ack:
+            self._poll_late_ack(message_handler)
+            return
         while True:
             mf, hf, message = self._get_input_message()
             if message is None:
+                self._metrics.empty_poll()
                 log.info("No message received, going to sleep for {} seconds".format(self._sleep_time))
                 time.sleep(self._sleep_time)
                 continue
             else:
-                self._current = message
-                self._current_priority = hf.priority
-                log.info("Received message: '{}' with priority ".format(message,hf.priority))
-                try:
-                    log.info("Calling handler")
-                    message_handler(message)
-                except Exception as error:
-                    log.exception("Message handler failure")
-                    self._send_fail_message(message)
-                else:
-                    log.info("Message successfully processed")
-                    self._send_success_message(message)
-                finally:
-                    self._current = None
-                    self._current_priority = 0
+                self._handle_message(message_handler, message, hf)
+
+    def _consume_messages(self, message_handler):
+        """Consume from the input queue over one long-lived connection.
+
+        Messages are pushed by the broker as soon as they are available,
+        with at most `prefetch` unacknowledged messages buffered locally,
+        and handled by a pool of `concurrency` worker threads while this
+        thread services the connection. If the connection drops it is
+        re-established after `sleep_time`.
+        """
+        self._executor = _executor(self._concurrency)
+        while True:
+            try:
+                self._connection, self._channel = self._channel_manager.connect()
+                self._drain_completed(message_handler)
+                self._channel.basic_qos(prefetch_count=self._prefetch)
+                self._channel.basic_consume(queue=self._input_q_params['queue'],
+                    on_message_callback=functools.partial(self._on_message, message_handler))
+                log.info("Consuming from queue '{}' with prefetch {} and {} worker(s)".format(
+                    self._input_q_params['queue'], self._prefetch, self._concurrency))
+                self._channel.start_consuming()
+            except TRANSPORT_ERRORS:
+                log.exception("Lost RabbitMQ connection, reconnecting in {} seconds".format(self._sleep_time))
+                time.sleep(self._sleep_time)
+            finally:
+                # Unacknowledged messages are redelivered by the broker
+                self._pending.clear()
+                self._unacked.clear()
+                if self._connection is not None and self._connection.is_open:
+                    self._connection.close()
+                self._connection = None
+                self._channel = None
+
+    def add_metrics_collector(self, render):
+        """Serve the metrics returned by render() alongside those of the message loop, see ProcessMetrics."""
+        self._metrics.add_collector(render)
+
+    def process(self, message_handler):
+        if self._metrics_port:
+            serve_metrics(self._metrics, self._metrics_port)
+        if self._consume:
+            self._consume_messages(message_handler)
+        else:
+            self._poll(message_handler)
 
 def add_pika_process_opts(parser):
     parser.add_option('-H', '--host', dest='host', type=str,
@@ -130,27 +946,121 @@ def add_pika_process_opts(parser):
     parser.add_option('', '--sleep_time', dest='sleep_time', type=float,
                       help='Time to sleep when input queue is empty',
                       default=30.0)
+    parser.add_option('', '--consume', dest='consume', action='store_true',
+                      help='Consume pushed messages over one long-lived connection instead of polling',
+                      default=False)
+    parser.add_option('', '--prefetch', dest='prefetch', type=int,
+                      help='Number of unacknowledged messages to prefetch in consume mode',
+                      default=1)
+    parser.add_option('', '--concurrency', dest='concurrency', type=int,
+                      help='Number of messages to handle in parallel (implies --consume)',
+                      default=1)
+    parser.add_option('', '--late_ack', dest='late_ack', action='store_true',
+                      help='Acknowledge messages only after the handler returns (at-least-once delivery). '
+                           'The broker consumer_timeout must exceed the longest handler run.',
+                      default=False)
+    parser.add_option('', '--max_attempts', dest='max_attempts', type=int,
+                      help='Number of times a failing message is attempted before it is dead-lettered '
+                           'to the fail queue', default=1)
+    parser.add_option('', '--retry_delay', dest='retry_delay', type=float,
+                      help='Delay in seconds before the first retry of a failed message', default=60.0)
+    parser.add_option('', '--retry_backoff', dest='retry_backoff', type=float,
+                      help='Factor by which the retry delay grows with each attempt', default=2.0)
+    parser.add_option('', '--ledger', dest='ledger', type=str,
+                      help='sqlite3 file recording completed messages; messages already recorded '
+                           'there are skipped', default=None)
+    parser.add_option('', '--metrics_port', dest='metrics_port', type=int,
+                      help='Serve Prometheus metrics over HTTP on this port (0 to disable)', default=0)
+    parser.add_option('', '--transport', dest='transport', type=str,
+                      help='Message transport: amqp (RabbitMQ), memory (in-process broker), '
+                           'memory://host:port (broker served by memory_broker.py) or, for stages '
+                           'with a database, db (queues in the Trapum database)', default="amqp")
+    parser.add_option('', '--codec', dest='codec', type='choice', choices=CODECS,
+                      help='Encoding of published packets: json or msgpack (msgpack+zlib, '
+                           'needs the msgpack package)', default="json")
     parser.add_option('', '--log_level',dest='log_level',type=str,
                       help='Logging level for pikaprocess logger', default="INFO")
 
 
 class PikaProducer(object):
-    def __init__(self, host, port, user, pwd, vhost, queue_params):
-        self._channel_manager = PikaChannel(host, port, user, pwd, vhost)
+    """Publisher holding a cached channel on a long-lived connection.
+
+    The connection is opened on first publish and kept for the lifetime
+    of the producer. If it has been dropped by the broker (e.g. missed
+    heartbeats while a long handler ran) it is re-established and the
+    unconfirmed remainder of the batch is published again.
+
+    With confirm set, the channel is put in transaction mode and messages
+    are committed `batch_size` at a time, so the broker acknowledges a
+    whole batch in one round trip. pika's BlockingChannel would otherwise
+    wait for a confirm after every basic_publish. publish() returns once
+    every message has been committed.
+    """
+    def __init__(self, host, port, user, pwd, vhost, queue_params, confirm=True, transport="amqp",
+                 batch_size=100):
+        self._channel_manager = PikaChannel(host, port, user, pwd, vhost, transport)
         self._queue_params = queue_params
         self._channel_manager.add_queue(**self._queue_params)
+        self._confirm = confirm
+        self._batch_size = max(1, batch_size)
+        self._committed = 0
+        self._connection = None
+        self._channel = None
+        self._lock = threading.Lock()
+
+    def _get_channel(self):
+        if (self._channel is None or not self._channel.is_open
+                or not self._connection.is_open):
+            self.close()
+            self._connection, self._channel = self._channel_manager.connect()
+            if self._confirm:
+                self._channel.tx_select()
+        return self._channel
+
+    def _publish_one(self, channel, message, priority, headers):
+        log.info("Publishing message '{}' to queue '{}'".format(message,self._queue_params["queue"]))
+        channel.basic_publish(exchange='', routing_key=self._queue_params["queue"], body=message,
+                              properties=stamped_properties(priority, headers))
 
     def publish(self, messages, priority=0):
-        with self._channel_manager as channel:
-            if hasattr(messages,"__iter__") and not isinstance(messages,(str,bytes)):
-                for message in messages:
-                    log.info("Publishing message '{}' to queue '{}'".format(message,self._queue_params["queue"]))
-                    channel.basic_publish(exchange='', routing_key=self._queue_params["queue"], body=message,
-                                          properties=pika.BasicProperties(delivery_mode = 2, priority=priority))
-            else:
-                log.info("Publishing message '{}' to queue '{}'".format(messages,self._queue_params["queue"]))
-                channel.basic_publish(exchange='', routing_key=self._queue_params["queue"], body=messages,
-                                      properties=pika.BasicProperties(delivery_mode = 2, priority=priority))
+        if not hasattr(messages,"__iter__") or isinstance(messages,(str,bytes)):
+            messages = [messages]
+        self.publish_messages([(message, priority, None) for message in messages])
+
+    def publish_messages(self, messages):
+        """Publish (body, priority, headers) tuples, each message with its own priority and headers."""
+        messages = list(messages)
+        with self._lock:
+            self._committed = 0
+            try:
+                self._publish_batches(messages)
+            except TRANSPORT_ERRORS:
+                # Messages of the uncommitted batch were discarded with the connection
+                log.warning("RabbitMQ connection lost, reconnecting to publish {} remaining message(s)".format(
+                    len(messages)-self._committed))
+                self.close()
+                self._publish_batches(messages)
+
+    def _publish_batches(self, messages):
+        """Publish the messages after the first self._committed, committing every batch_size."""
+        channel = self._get_channel()
+        while self._committed < len(messages):
+            batch = messages[self._committed:self._committed+self._batch_size]
+            for message, priority, headers in batch:
+                self._publish_one(channel, message, priority, headers)
+            if self._confirm:
+                channel.tx_commit()
+            self._committed += len(batch)
+
+    def close(self):
+        if self._connection is not None and self._connection.is_open:
+            log.debug("Closing RabbitMQ connection")
+            try:
+                self._connection.close()
+            except TRANSPORT_ERRORS:
+                pass
+        self._connection = None
+        self._channel = None
 
 def add_pika_producer_opts(parser):
     parser.add_option('-H', '--host', dest='host', type=str,
@@ -165,6 +1075,13 @@ def add_pika_producer_opts(parser):
                       help='RabbitMQ vhost', default="/")
     parser.add_option('-q', '--queue', dest='queue', type=str,
                       help='Name of queue to publish to', default="beam_merge")
+    parser.add_option('', '--transport', dest='transport', type=str,
+                      help='Message transport: amqp (RabbitMQ), memory (in-process broker), '
+                           'memory://host:port (broker served by memory_broker.py) or, for stages '
+                           'with a database, db (queues in the Trapum database)', default="amqp")
+    parser.add_option('', '--codec', dest='codec', type='choice', choices=CODECS,
+                      help='Encoding of published packets: json or msgpack (msgpack+zlib, '
+                           'needs the msgpack package)', default="json")
     parser.add_option('', '--log_level',dest='log_level',type=str,
                       help='Logging level for pikaprocess logger', default="INFO")
     
@@ -175,9 +1092,34 @@ def pika_producer_from_opts(opts):
     producer = PikaProducer(opts.host, opts.port,
                            opts.user, opts.password,
                            opts.vhost,
-                           {"queue":opts.queue, "durable": True, "arguments":{"x-max-priority":10}})
+                           {"queue":opts.queue, "durable": True, "arguments":{"x-max-priority":10}},
+                           transport=opts.transport)
     return producer
 
+# Process-wide producers keyed on broker and queue, see shared_producer_from_opts
+_producers = {}
+_producers_lock = threading.Lock()
+
+def shared_producer_from_opts(opts):
+    """
+    Return the process-wide producer for the broker and queue in opts,
+    creating it on first use. Subsequent calls reuse its connection.
+    """
+    key = (opts.transport, opts.host, opts.port, opts.user, opts.vhost, opts.queue)
+    with _producers_lock:
+        producer = _producers.get(key)
+        if producer is None:
+            producer = pika_producer_from_opts(opts)
+            _producers[key] = producer
+    return producer
+
+@atexit.register
+def close_shared_producers():
+    with _producers_lock:
+        for producer in _producers.values():
+            producer.close()
+        _producers.clear()
+
 def pika_process_from_opts(opts):
     log.setLevel(opts.log_level.upper())
     logging.getLogger("pika").setLevel("WARN")
@@ -187,7 +1129,11 @@ def pika_process_from_opts(opts):
                           {"queue":opts.input_queue, "durable": True, "arguments":{"x-max-priority":10}},
                           {"queue":opts.success_queue, "durable": True, "arguments":{"x-max-priority":10}},
                           {"queue":opts.fail_queue, "durable": True, "arguments":{"x-max-priority":10}},
-                          opts.sleep_time)
+                          opts.sleep_time, opts.consume, opts.prefetch,
+                          opts.concurrency, opts.late_ack,
+                          RetryPolicy(opts.max_attempts, opts.retry_delay, opts.retry_backoff),
+                          opts.transport, opts.metrics_port,
+                          CompletionLedger(opts.ledger) if opts.ledger else None)
     return process
 
 def test_process(pika_process):
@@ -201,9 +1147,9 @@ def test_process(pika_process):
         time.sleep(1000000)
     pika_process.process(handler)
 
-def publish_info(opts,info):
-    producer = pika_producer_from_opts(opts)
-    message = json.dumps(info)
+def publish_info(opts,info,schema=None):
+    producer = shared_producer_from_opts(opts)
+    message = encode_message(info, schema, getattr(opts, "codec", "json"))
     log.debug("Sending info to the user's info queue %s"%message)
     try:
         producer.publish(message)
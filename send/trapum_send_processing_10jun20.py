@@ -5,7 +5,9 @@ import parseheader
 import os
 import logging
 import sys
+import math
 import pika_process
+import db_broker
 from datetime import datetime
 import trapum_db_send
 
@@ -28,6 +30,92 @@ def get_beam_list(path):  ### Old structure
     unique_beam_list = subprocess.getoutput(script)
     return unique_beam_list.split('\n')
 
+def connect_trapum():
+    # TRAPUM_DB_DSN, e.g. sqlite:///trapum.db, selects a database other than the server below
+    if os.environ.get("TRAPUM_DB_DSN"):
+        return trapum_db_send.open_database(os.environ["TRAPUM_DB_DSN"])
+    return trapum_db_send.TrapumDataBase("db_host","db_port","db_name","db_user","db_passwd")
+
+def scan_tobs(files,opts):
+    """
+    Read the observation length of each file from its header, parsing all of them at once.
+
+    @return dictionary of file to tobs, without the files whose header could not be read
+    """
+    catalogue = parseheader.scan_headers(files,opts.header_workers)
+    return dict((f,t) for f,t,valid in zip(files,catalogue["tobs"],catalogue["valid"]) if valid)
+
+def submit_from_database(opts):
+    """
+    Submit merges of the raw files that the pipeline has not processed
+    yet, found in the database rather than by walking the observation
+    directories. Files are merged per beam in groups of opts.length
+    seconds, as when walking the directories.
+    """
+    trapum = connect_trapum()
+    pipeline_id = trapum.get_pipeline_id_from_name(opts.pipeline)
+
+    dp_ids = list(trapum.iter_non_processed_dp_ids_for_pipeline(opts.pipeline,opts.page_size,
+                                                                raw_only=True,retry_failed=opts.retry_failed))
+    log.info("Found %d data products not processed by %s"%(len(dp_ids),opts.pipeline))
+    beams = {}
+    for row in trapum.get_file_info_for_dp_ids(dp_ids).values():
+        beams.setdefault((row.pointing_id,row.beam_id),[]).append(row)
+
+    for rows in beams.values():
+        rows.sort(key=lambda row: row.filename)
+    tobs = {}
+    if opts.length != 'full':
+        tobs = scan_tobs([os.path.join(rows[0].filepath,rows[0].filename) for rows in beams.values()],opts)
+
+    for rows in beams.values():
+        files = [os.path.join(row.filepath,row.filename) for row in rows]
+        beam_path = os.path.dirname(files[0])
+        beam_name = os.path.basename(beam_path)
+        if opts.length == 'full':
+            no_of_files_per_merge = len(files)
+        elif files[0] not in tobs:
+            log.error("Could not read the header of %s, skipping beam %s"%(files[0],beam_path))
+            continue
+        else:
+            no_of_files_per_merge = max(1,int(round(float(opts.length)/tobs[files[0]])))
+        if len(files) < no_of_files_per_merge:
+            log.info("Only %d unprocessed files left for beam %s, fewer than a merge"%(len(files),beam_path))
+            continue
+
+        new_path = os.path.dirname(beam_path)
+        subdirectory_name = new_path.split('/')[-2]+'/'+new_path.split('/')[-1]
+        final_merge_path = opts.merged_path + '/' + subdirectory_name +'/' + beam_name
+        subprocess.call("mkdir -p %s"%(final_merge_path),shell=True)
+
+        no_of_merges = int(math.ceil(float(len(files))/no_of_files_per_merge))
+        for merges in range(no_of_merges):
+            # The last merge overlaps the one before rather than being short
+            end = min((merges+1)*no_of_files_per_merge,len(files))
+            group = rows[end-no_of_files_per_merge:end]
+            subgroup_files = " ".join(files[end-no_of_files_per_merge:end])
+            # Named after the first data product, merges of a beam are submitted over several runs
+            filename = "%s_t1_f1_merge_dp%d.fil"%(beam_name,group[0].dp_id)
+            if opts.time_ds:
+                digifil_script = "/beegfs/u/prajwalvp/digifil %s -threads 15 -b 8 -t %d  -o %s/%s"%(subgroup_files,opts.time_ds,final_merge_path,filename)
+            else:
+                digifil_script = "/beegfs/u/prajwalvp/digifil %s -threads 15 -b 8  -o %s/%s"%(subgroup_files,final_merge_path,filename)
+
+            info = {}
+            info['script'] = digifil_script
+            info['subgroup_files'] = subgroup_files
+            info['dp_ids'] = [row.dp_id for row in group]
+            info['output_path'] = final_merge_path
+            info['filename'] = filename
+            submit_time = str(datetime.now())
+            info["processing_id"] = trapum.create_processing(pipeline_id,submit_time,"enqueued","resubmitted from database")
+            # Pivot now so that queued merges are not found unprocessed by the next run
+            trapum.create_pivots(info['dp_ids'],info["processing_id"])
+
+            log.debug("Ready to publish to RabbitMQ")
+            pika_process.publish_info(opts,info,"search")
+    trapum.close()
+
 
 
 
@@ -43,15 +131,26 @@ if __name__=="__main__":
     parser.add_option('--beam_numbers',type=str,help='Give beam numbers as list',dest='beam_list',default="unset")
     parser.add_option('--downsample_tfactor',type=int,help='downsample factor in time',dest='time_ds')
     parser.add_option('--downsample_ffactor',type=int,help='downsample factor in frequency',dest='freq_ds',default=1)
+    parser.add_option('--from_db',action='store_true',help='Submit the raw files the pipeline has not processed, found in the database, instead of walking --observation_path',dest='from_db',default=False)
+    parser.add_option('--pipeline',type=str,help='pipeline the merges are submitted to, with --from_db',dest='pipeline',default="peasoup32")
+    parser.add_option('--page_size',type=int,help='data products looked up per query, with --from_db',dest='page_size',default=1000)
+    parser.add_option('--header_workers',type=int,help='threads reading filterbank headers',dest='header_workers',default=16)
+    parser.add_option('--retry_failed',action='store_true',help='with --from_db, also submit files whose processings all failed',dest='retry_failed',default=False)
     opts,args = parser.parse_args() 
-    
-    new_paths = [x[0] for x in os.walk(opts.observation)]
-
 
     # Setup logging config
     log_type=opts.log_level
     log.setLevel(log_type.upper())
 
+    # --transport db keeps the queues in the database instead of RabbitMQ
+    pika_process.register_transport("db",lambda url,parameters: db_broker.connect(connect_trapum))
+
+    if opts.from_db:
+        submit_from_database(opts)
+        sys.exit(0)
+
+    new_paths = [x[0] for x in os.walk(opts.observation)]
+
 
  
     # Create directory
@@ -85,6 +184,11 @@ if __name__=="__main__":
 
             log.info("Number of beams to process: %d"%len(unique_beam_list))
 
+            # Parse the header of the first file of every beam in one go
+            if opts.length != 'full':
+                beam_files = dict((beam_name,sorted(glob.glob(new_path+'/'+beam_name+'/*.fil'))[2:]) for beam_name in unique_beam_list) # Ignore first 10 min due to  jump
+                tobs = scan_tobs([files[0] for files in beam_files.values() if files],opts)
+
 
             # Retrieve partial filename and create subdirectory
 
@@ -134,30 +238,32 @@ if __name__=="__main__":
 
 
 
-                files_per_beam = sorted(glob.glob(new_path+'/'+beam_name+'/*.fil'))[2:] # Ignore first 10 min due to  jump
+                files_per_beam = beam_files[beam_name]
                 
                 if len(files_per_beam) ==1:
                     log.info("No need to merge since one file recorded per beam")
                     sys.exit(0)
 
                 
-                file_info1 = parseheader.parseSigprocHeader(files_per_beam[0])
-                file_info = parseheader.updateHeader(file_info1)
+                if files_per_beam[0] not in tobs:
+                    log.error("Could not read the header of %s, skipping beam %s"%(files_per_beam[0],beam_name))
+                    continue
+                beam_tobs = tobs[files_per_beam[0]]
 
 
 
-                if float(opts.length)/float(file_info['tobs']) < 2.0 :
+                if float(opts.length)/beam_tobs < 2.0 :
                     log.info("No need to merge since required length is smaller than two files")
                     continue
                     #sys.exit(0)
-                elif float(opts.length) > len(files_per_beam)*file_info['tobs']:
+                elif float(opts.length) > len(files_per_beam)*beam_tobs:
                     #log.info("Length asked for exceeds total observation length!!")
                     continue
                     #sys.exit(0)
                 else:
-                    no_of_files_per_merge = int(round(float(opts.length)/file_info['tobs']))
+                    no_of_files_per_merge = int(round(float(opts.length)/beam_tobs))
                     log.info("Number of files in merge: %d"%no_of_files_per_merge)
-                    print(len(files_per_beam),file_info['tobs'])
+                    print(len(files_per_beam),beam_tobs)
                     if len(files_per_beam)%2==0:
                         no_of_merges = int(len(files_per_beam)/no_of_files_per_merge)
                     else:
@@ -165,8 +271,12 @@ if __name__=="__main__":
 
                     log.info("Number of merges: %d"%no_of_merges)
                      
-                    actual_length = no_of_files_per_merge*float(file_info['tobs'])
+                    actual_length = no_of_files_per_merge*beam_tobs
                     log.info("Closest length to given length: %f"%actual_length)
+
+                    # Get data product ids for every file of the beam in one go
+                    trapum = connect_trapum()
+                    beam_dp_ids = trapum.get_dp_ids_for_filenames([os.path.basename(f) for f in files_per_beam])
                    
                     
                     for merges in range(no_of_merges):
@@ -178,12 +288,7 @@ if __name__=="__main__":
                             subgroup_files = " ".join(files_per_beam[merges*no_of_files_per_merge:(merges+1)*no_of_files_per_merge])  
 
                         # Get respective data product ids for each list of files 
-                        #trapum = trapum_db_external.TrapumDataBase();
-                        trapum = trapum_db_send.TrapumDataBase("db_host","db_port","db_name","db_user","db_passwd");
-                        dp_ids=[]
-                        for ind_file in subgroup_files.split(' '):
-                            #print (ind_file)
-                            dp_ids.append(trapum.get_dp_id_from_filename(os.path.basename(ind_file))[0])                            
+                        dp_ids = [beam_dp_ids[os.path.basename(ind_file)] for ind_file in subgroup_files.split(' ')]
 
                         if opts.time_ds:  
                             digifil_script = "/beegfs/u/prajwalvp/digifil %s -threads 15 -b 8 -t %d  -o %s/%s_t1_f1_merge_%d.fil"%(subgroup_files,opts.time_ds,final_merge_path,beam_name,merges)
@@ -208,6 +313,8 @@ if __name__=="__main__":
 
                         submit_time = str(datetime.now()) 
                         info["processing_id"] = trapum.create_processing(pipeline_id,submit_time,"enqueued")
+                        # Pivot now so that queued merges are not found unprocessed by --from_db
+                        trapum.create_pivots(dp_ids,info["processing_id"])
 
                         #print processing_id
 
@@ -215,6 +322,6 @@ if __name__=="__main__":
 
                         # Publish to Rabbit
                         log.debug("Ready to publish to RabbitMQ")
-                        pika_process.publish_info(opts,info)
+                        pika_process.publish_info(opts,info,"search")
 
                            
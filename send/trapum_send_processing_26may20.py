@@ -28,6 +28,12 @@ def get_beam_list(path):  ### Old structure
     unique_beam_list = subprocess.getoutput(script)
     return unique_beam_list.split('\n')
 
+def connect_trapum():
+    # TRAPUM_DB_DSN, e.g. sqlite:///trapum.db, selects a database other than the server below
+    if os.environ.get("TRAPUM_DB_DSN"):
+        return trapum_db_send.open_database(os.environ["TRAPUM_DB_DSN"])
+    return trapum_db_send.TrapumDataBase("db_host","db_port","db_name","db_user","db_passwd")
+
 
 
 
@@ -172,6 +178,10 @@ if __name__=="__main__":
                      
                     actual_length = no_of_files_per_merge*float(file_info['tobs'])
                     log.info("Closest length to given length: %f"%actual_length)
+
+                    # Get data product ids for every file of the beam in one go
+                    trapum = connect_trapum()
+                    beam_dp_ids = trapum.get_dp_ids_for_filenames([os.path.basename(f) for f in files_per_beam])
                    
                     
                     for merges in range(no_of_merges):
@@ -183,12 +193,7 @@ if __name__=="__main__":
                             subgroup_files = " ".join(files_per_beam[merges*no_of_files_per_merge:(merges+1)*no_of_files_per_merge])  
 
                         # Get respective data product ids for each list of files 
-                        #trapum = trapum_db_external.TrapumDataBase();
-                        trapum = trapum_db_send.TrapumDataBase("db_host","db_port","db_name","db_user","db_passwd");
-                        dp_ids=[]
-                        for ind_file in subgroup_files.split(' '):
-                            #print (ind_file)
-                            dp_ids.append(trapum.get_dp_id_from_filename(os.path.basename(ind_file))[0])                            
+                        dp_ids = [beam_dp_ids[os.path.basename(ind_file)] for ind_file in subgroup_files.split(' ')]
 
                         if opts.time_ds:  
                             digifil_script = "/beegfs/u/prajwalvp/digifil %s -threads 15 -b 8 -t %d  -o %s/%s_t1_f1_merge_%d.fil"%(subgroup_files,opts.time_ds,final_merge_path,beam_name,merges)
@@ -219,6 +224,6 @@ if __name__=="__main__":
 
                         # Publish to Rabbit
                         log.debug("Ready to publish to RabbitMQ")
-                        pika_process.publish_info(opts,info)
+                        pika_process.publish_info(opts,info,"search")
 
                            
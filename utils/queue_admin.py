@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import base64
+import logging
+import optparse
+import pika_process
+
+
+log = logging.getLogger('queue_admin')
+FORMAT = "[%(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s"
+logging.basicConfig(format=FORMAT)
+
+USAGE = """%prog COMMAND [options]
+
+Commands:
+  count    Print the number of messages ready in the queue
+  purge    Delete every message in the queue
+  drain    Move messages from the queue into a JSONL file
+  inspect  Copy messages from the queue into a JSONL file, leaving them queued
+  inject   Publish messages from a JSONL file to the queue"""
+
+COMMANDS = ("count", "purge", "drain", "inspect", "inject")
+
+
+def parse_filters(filters):
+    """
+    @brief   Parse field=value filters given on the command line
+
+    @params  filters   list of "field=value" strings
+
+    @return  dictionary of field to value
+    """
+    parsed = {}
+    for item in filters or []:
+        field, value = item.split("=", 1)
+        parsed[field] = value
+    return parsed
+
+def matches(body, filters):
+    """Check whether a message has every filtered field at the given value."""
+    if not filters:
+        return True
+    try:
+        packet = pika_process.decode_message(body)
+    except pika_process.InvalidMessage:
+        return False
+    return all(str(packet.get(field)) == value for field, value in filters.items())
+
+def message_to_record(body, properties):
+    record = {"priority": properties.priority or 0, "headers": properties.headers or {}}
+    try:
+        record["body"] = body.decode("utf-8")
+    except UnicodeDecodeError:
+        record["body_b64"] = base64.b64encode(body).decode("ascii")
+    return record
+
+def record_to_message(record):
+    if "body_b64" in record:
+        body = base64.b64decode(record["body_b64"])
+    else:
+        body = record["body"].encode("utf-8")
+    # Broker bookkeeping from the original delivery is not carried over
+    headers = {k: v for k, v in (record.get("headers") or {}).items() if k != "x-death"}
+    return body, record.get("priority", 0), headers or None
+
+
+def persist(f):
+    """Make sure what was written to f is on disk, before the messages in it are acknowledged."""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def count_messages(channel, opts):
+    return channel.queue_declare(queue=opts.queue, passive=True).method.message_count
+
+def purge_messages(channel, opts):
+    return channel.queue_purge(queue=opts.queue).method.message_count
+
+def export_messages(channel, opts, remove):
+    """
+    @brief   Write the messages on the queue to a JSONL file
+
+    Messages are streamed with basic_consume. When removing every message
+    the acknowledgements are batched with multiple=True every `prefetch`
+    messages. When filtering, or when only inspecting, messages that are
+    not removed are held until the end and then returned to the queue in
+    one nack. The file is flushed and synced before every acknowledgement,
+    so a removed message is always on disk.
+
+    @params  remove  Remove the exported messages from the queue
+
+    @return  (number of messages read, number of messages written)
+    """
+    filters = parse_filters(opts.filters)
+    total = count_messages(channel, opts)
+    if total == 0:
+        return 0, 0
+    batch_ack = remove and not filters
+    channel.basic_qos(prefetch_count=opts.prefetch if batch_ack else 0)
+    seen = written = 0
+    last_tag = None
+    with open(opts.file, "a") as f:
+        for method, properties, body in channel.consume(opts.queue, inactivity_timeout=opts.timeout):
+            if method is None:
+                log.info("Queue '{}' idle for {} seconds, stopping".format(opts.queue, opts.timeout))
+                break
+            seen += 1
+            if matches(body, filters):
+                f.write(json.dumps(message_to_record(body, properties), default=str)+"\n")
+                written += 1
+                if remove and filters:
+                    persist(f)
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+            last_tag = method.delivery_tag
+            if batch_ack and seen % max(1, opts.prefetch//2) == 0:
+                persist(f)
+                channel.basic_ack(delivery_tag=last_tag, multiple=True)
+            if seen >= total:
+                break
+        persist(f)
+    channel.cancel()
+    if batch_ack and last_tag is not None:
+        channel.basic_ack(delivery_tag=last_tag, multiple=True)
+    elif last_tag is not None:
+        channel.basic_nack(delivery_tag=0, multiple=True, requeue=True)
+    return seen, written
+
+def inject_messages(opts, chunk_size=10000):
+    """
+    @brief   Publish the messages in a JSONL file to the queue
+
+    Messages go through PikaProducer, which commits them a batch at a
+    time like the stage producers. The file is read chunk_size records
+    at a time so it never has to fit in memory.
+
+    @params  chunk_size  Number of records handed to the producer at once
+
+    @return  number of messages published
+    """
+    filters = parse_filters(opts.filters)
+    producer = pika_process.pika_producer_from_opts(opts)
+    published = 0
+    chunk = []
+    try:
+        with open(opts.file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                body, priority, headers = record_to_message(json.loads(line))
+                if not matches(body, filters):
+                    continue
+                chunk.append((body, priority, headers))
+                if len(chunk) == chunk_size:
+                    producer.publish_messages(chunk)
+                    published += len(chunk)
+                    chunk = []
+        if chunk:
+            producer.publish_messages(chunk)
+            published += len(chunk)
+    finally:
+        producer.close()
+    return published
+
+
+if __name__=='__main__':
+
+    parser = optparse.OptionParser(usage=USAGE)
+    pika_process.add_pika_producer_opts(parser)
+    parser.add_option('-f', '--file', dest='file', type=str,
+                      help='JSONL file to drain/inspect to or inject from', default="messages.jsonl")
+    parser.add_option('', '--filter', dest='filters', action='append',
+                      help='Only act on messages with field=value, e.g. processing_id=42 (repeatable)')
+    parser.add_option('', '--prefetch', dest='prefetch', type=int,
+                      help='Number of messages to prefetch when draining', default=1000)
+    parser.add_option('', '--timeout', dest='timeout', type=float,
+                      help='Stop draining after this many seconds without a message', default=5.0)
+    opts,args = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in COMMANDS:
+        parser.error("Expected one command out of: {}".format(", ".join(COMMANDS)))
+    command = args[0]
+    log.setLevel(opts.log_level.upper())
+    logging.getLogger("pika").setLevel("WARN")
+
+    if command == "inject":
+        log.info("Published {} messages from {} to '{}'".format(
+            inject_messages(opts), opts.file, opts.queue))
+        sys.exit(0)
+
+    channel_manager = pika_process.PikaChannel(opts.host, opts.port, opts.user,
+                                               opts.password, opts.vhost, opts.transport)
+    with channel_manager as channel:
+        if command == "count":
+            print(count_messages(channel, opts))
+        elif command == "purge":
+            log.info("Purged {} messages from '{}'".format(purge_messages(channel, opts), opts.queue))
+        elif command in ("drain", "inspect"):
+            seen, written = export_messages(channel, opts, remove=command == "drain")
+            log.info("Read {} messages from '{}', wrote {} to {}".format(seen, opts.queue, written, opts.file))